@@ -4,7 +4,7 @@
 __init__.py
 
 """
-__all__ = ['common', 'download', 'packager', 'tap', 'pdap', 'geogen']
+__all__ = ['common', 'download', 'packager', 'tap', 'pdap', 'geogen', 'transport', 'cache', 'compress']
 
 # Set up the root logger
 
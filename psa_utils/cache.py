@@ -0,0 +1,316 @@
+#!/usr/bin/python
+"""cache.py
+
+Mark S. Bentley (mark@lunartech.org), 2021
+
+Caches used to avoid repeating queries of the PSA, and work on unchanged files
+"""
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+import pandas as pd
+
+import logging
+log = logging.getLogger(__name__)
+
+cache_dir = os.path.join(os.path.expanduser('~'), '.psa_utils', 'cache')
+cache_ttl = 24 * 3600 # seconds
+cache_size = 1024 * 1024 * 1024 # bytes
+
+
+class ResultCache():
+    """A cache of DataFrames on disk, stored in Feather (Arrow) format. Entries
+    expire after ttl seconds, and when the cache grows beyond max_size bytes
+    the least recently used entries are removed"""
+
+    suffix = '.feather'
+
+    def __init__(self, directory=cache_dir, ttl=cache_ttl, max_size=cache_size):
+        """Accepts the following:
+
+        directory - the directory holding the cache (created if needed)
+        ttl - lifetime of an entry in seconds (None for no expiry)
+        max_size - maximum total size of the cache in bytes
+        """
+
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            import pyarrow
+            self.enabled = True
+        except ModuleNotFoundError:
+            log.warning('pyarrow module not available, result caching disabled')
+            self.enabled = False
+
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    @staticmethod
+    def key(*parts):
+        """Returns a cache key built from the given strings"""
+
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+    def _path(self, key):
+
+        return os.path.join(self.directory, key + self.suffix)
+
+
+    def get(self, key):
+        """Returns the DataFrame cached under key, or None if there is no valid entry"""
+
+        path = self._path(key)
+        if not self.enabled or not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        # the modification time records when the entry was written and
+        # the access time when it was last used
+        stat = os.stat(path)
+        now = time.time()
+        if self.ttl is not None and now - stat.st_mtime > self.ttl:
+            log.debug('cache entry {:s} expired'.format(key))
+            os.remove(path)
+            self.misses += 1
+            return None
+
+        try:
+            data = pd.read_feather(path)
+        except Exception as err:
+            log.warning('removing unreadable cache entry {:s} ({:s})'.format(key, str(err)))
+            os.remove(path)
+            self.misses += 1
+            return None
+
+        os.utime(path, (now, stat.st_mtime))
+        self.hits += 1
+
+        return data
+
+
+    def put(self, key, data):
+        """Stores the DataFrame data under key, and evicts entries as needed"""
+
+        if not self.enabled or data is None:
+            return
+
+        path = self._path(key)
+        try:
+            data.reset_index(drop=True).to_feather(path + '.tmp')
+        except Exception as err:
+            log.warning('could not cache result ({:s})'.format(str(err)))
+            if os.path.exists(path + '.tmp'):
+                os.remove(path + '.tmp')
+            return
+        os.replace(path + '.tmp', path)
+
+        self.evict()
+
+        return
+
+
+    def evict(self):
+        """Removes expired entries, then the least recently used entries
+        until the cache is within max_size"""
+
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.suffix):
+                continue
+            stat = entry.stat()
+            if self.ttl is not None and now - stat.st_mtime > self.ttl:
+                os.remove(entry.path)
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for atime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            log.debug('evicting cache entry {:s}'.format(os.path.basename(path)))
+            os.remove(path)
+            total -= size
+
+        return
+
+
+    def clear(self):
+        """Removes all entries from the cache"""
+
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                os.remove(entry.path)
+
+        return
+
+
+class LabelCache():
+    """A cache of PDS4 labels on disk, keyed by LIDVID. Since the label of a
+    given LIDVID never changes, entries do not expire"""
+
+    suffix = '.xml'
+
+    def __init__(self, directory=os.path.join(cache_dir, 'labels')):
+        """Accepts the directory holding the cache (created if needed)"""
+
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def _path(self, lidvid):
+
+        return os.path.join(self.directory, ResultCache.key(lidvid) + self.suffix)
+
+
+    def get(self, lidvid):
+        """Returns the label bytes cached for lidvid, or None"""
+
+        path = self._path(lidvid)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.hits += 1
+
+        return content
+
+
+    def put(self, lidvid, content):
+        """Stores the label bytes content under lidvid"""
+
+        path = self._path(lidvid)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+
+        return
+
+
+    def clear(self):
+        """Removes all entries from the cache"""
+
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                os.remove(entry.path)
+
+        return
+
+
+class FingerprintCache():
+    """A persistent store of results derived from local files - the MD5
+    checksum of a file, and the parsed content of a PDS4 label - which are
+    valid for as long as the file is unchanged, as judged by its path, size,
+    modification time and inode. Stored in an SQLite database"""
+
+    def __init__(self, filename=os.path.join(cache_dir, 'fingerprints.sqlite')):
+        """Accepts the database file (created if needed)"""
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.filename = filename
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, md5 TEXT, label TEXT)')
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    @staticmethod
+    def fingerprint(path):
+        """Returns the (size, mtime, inode) tuple identifying the state of path"""
+
+        stat = os.stat(path)
+
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+    def _get(self, path, column):
+
+        path = os.path.abspath(path)
+        fingerprint = self.fingerprint(path)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime, inode, {:s} FROM files WHERE path=?'.format(column), (path,)).fetchone()
+            if row is None or tuple(row[:3]) != fingerprint or row[3] is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return row[3]
+
+
+    def _put(self, path, column, value):
+
+        path = os.path.abspath(path)
+        fingerprint = self.fingerprint(path)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, inode FROM files WHERE path=?', (path,)).fetchone()
+            if row is not None and tuple(row) == fingerprint:
+                self.db.execute('UPDATE files SET {:s}=? WHERE path=?'.format(column), (value, path))
+            else: # new or changed, so anything else stored is stale
+                self.db.execute(
+                    'INSERT OR REPLACE INTO files (path, size, mtime, inode, {:s}) VALUES (?, ?, ?, ?, ?)'.format(column),
+                    (path,) + fingerprint + (value,))
+
+        return
+
+
+    def get_md5(self, path):
+        """Returns the stored MD5 checksum of path, or None if unknown or stale"""
+
+        return self._get(path, 'md5')
+
+
+    def put_md5(self, path, md5):
+        """Stores the MD5 checksum of path"""
+
+        self._put(path, 'md5', md5)
+
+
+    def get_label(self, path):
+        """Returns the stored dictionary describing the label path, or None
+        if unknown or stale"""
+
+        label = self._get(path, 'label')
+
+        return None if label is None else json.loads(label)
+
+
+    def put_label(self, path, label):
+        """Stores a (JSON serialisable) dictionary describing the label path"""
+
+        self._put(path, 'label', json.dumps(label))
+
+
+    def commit(self):
+        """Writes any changes to disk"""
+
+        with self.lock:
+            self.db.commit()
+
+        return
+
+
+    def clear(self):
+        """Removes all entries"""
+
+        with self.lock:
+            self.db.execute('DELETE FROM files')
+            self.db.commit()
+
+        return
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+"""compress.py
+
+Mark S. Bentley (mark@lunartech.org), 2021
+
+Selectable compression for the tarballs delivered to the PSA
+"""
+
+import os
+import time
+import zlib
+import shutil
+import struct
+import tarfile
+import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+log = logging.getLogger(__name__)
+
+backends = ['gzip', 'parallel', 'pigz']
+backend = 'gzip' # default backend used by open_tarball
+level = 9 # default compression level (1-9), as tarfile uses for w:gz
+workers = os.cpu_count() or 1 # threads (or pigz processes) compressing in parallel
+block_size = 1024 * 1024 # bytes of input compressed as one block by the parallel backend
+
+
+def open_tarball(filename, backend=None, level=None, workers=None):
+    """Opens a tarball for writing to filename, compressed as gzip by one of
+    the following backends (None uses the module setting of the same name):
+
+    gzip - the single-threaded zlib stream of tarfile
+    parallel - blocks of block_size bytes compressed on a pool of workers
+        threads, in the manner of pigz
+    pigz - piped through the external pigz program, if it is installed
+        (otherwise parallel is used)
+
+    All produce a standard single-member .tar.gz file. level is the
+    compression level from 1 (fastest) to 9 (smallest). Returns a
+    tarfile.TarFile which closes the compressor when it is closed, and
+    raises ValueError for an unknown backend."""
+
+    backend = globals()['backend'] if backend is None else backend
+    level = globals()['level'] if level is None else level
+    workers = globals()['workers'] if workers is None else workers
+
+    if backend not in backends:
+        log.error('compression backend must be one of: {:s}'.format(', '.join(backends)))
+        raise ValueError
+
+    if backend == 'pigz' and shutil.which('pigz') is None:
+        log.warning('pigz not found, using the parallel backend')
+        backend = 'parallel'
+
+    if backend == 'gzip':
+        return tarfile.open(filename, 'w:gz', compresslevel=level)
+    elif backend == 'pigz':
+        fileobj = PigzFile(filename, level=level, workers=workers)
+    else:
+        fileobj = ParallelGzipFile(filename, level=level, workers=workers)
+
+    return TarFile(fileobj=fileobj, mode='w')
+
+
+class TarFile(tarfile.TarFile):
+    """A TarFile which also closes the (compressing) file object it writes to"""
+
+    def close(self):
+
+        try:
+            super().close()
+        finally:
+            self.fileobj.close()
+
+    def __exit__(self, type, value, traceback):
+
+        # tarfile only closes a file object it opened itself if the block raised
+        try:
+            super().__exit__(type, value, traceback)
+        finally:
+            if type is not None:
+                self.fileobj.close()
+
+
+class ParallelGzipFile():
+    """A write-only file object producing gzip output. Input is split into
+    blocks which are deflated concurrently on a thread pool, each primed
+    with the last 32 KiB of the previous block and ended with a sync flush,
+    so that the blocks join into one deflate stream (as pigz does)"""
+
+    def __init__(self, filename, level=level, workers=workers, block_size=block_size):
+
+        self.f = open(filename, 'wb')
+        self.level = level
+        self.workers = max(1, workers)
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+
+        xfl = 2 if level == 9 else 4 if level == 1 else 0
+        self.f.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + bytes([xfl, 255]))
+
+
+    def write(self, data):
+
+        self.buffer += data
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block)
+
+        return len(data)
+
+
+    def tell(self):
+
+        return self.size
+
+
+    def _submit(self, block, last=False):
+
+        self.pending.append(self.executor.submit(deflate, block, self.dictionary, self.level, last))
+        self.dictionary = block[-32768:]
+
+        # write out finished blocks in order, keeping a bounded number in flight
+        while self.pending and (len(self.pending) > 2 * self.workers or self.pending[0].done()):
+            self.f.write(self.pending.popleft().result())
+
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        try:
+            self._submit(bytes(self.buffer), last=True)
+            self.buffer = bytearray()
+            while self.pending:
+                self.f.write(self.pending.popleft().result())
+            self.f.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.f.close()
+            self.closed = True
+
+        return
+
+
+def deflate(block, dictionary, level, last):
+    """Returns the raw deflate data of block, primed with dictionary and
+    ending the stream if last, or with a sync flush otherwise"""
+
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class PigzFile():
+    """A write-only file object piping its input through pigz to filename.
+    If pigz fails, write or close raises subprocess.CalledProcessError"""
+
+    def __init__(self, filename, level=level, workers=workers):
+
+        self.f = open(filename, 'wb')
+        self.process = subprocess.Popen(
+            ['pigz', '-{:d}'.format(level), '-p', str(max(1, workers)), '-c'], stdin=subprocess.PIPE, stdout=self.f)
+        self.size = 0
+        self.closed = False
+
+
+    def write(self, data):
+
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            # pigz has exited, close reports how
+            self.close()
+            raise
+        self.size += len(data)
+
+        return len(data)
+
+
+    def tell(self):
+
+        return self.size
+
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        broken = False
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            broken = True
+        finally:
+            returncode = self.process.wait()
+            self.f.close()
+            self.closed = True
+        if returncode != 0 or broken:
+            log.error('pigz exited with status {:d}'.format(returncode))
+            raise subprocess.CalledProcessError(returncode, self.process.args)
+
+        return
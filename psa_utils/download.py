@@ -7,17 +7,44 @@ A module to download public PSA products
 """
 
 import os
+import json
+import time
+import tempfile
+import threading
+import contextlib
+import collections
 import requests
 import re
 import pathlib
+import numpy as np
+import pandas as pd
 from lxml import etree
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 
 from . import pdap
 from . import tap
+from . import transport
 
 import logging
 log = logging.getLogger(__name__)
 
+download_workers = 4 # number of concurrent product downloads
+download_retries = 3 # number of times an interrupted transfer is resumed
+download_chunk_size = 65536 # bytes
+download_journal = '.psa_download_journal' # batch progress, kept in output_dir
+sync_state = '.psa_sync_state.json' # products fetched in mirror mode, kept in output_dir
+spool_size = 256 * 1024 * 1024 # bytes of each streamed zip held in memory before spilling to disk
+label_extensions = ('.xml', '.lbl') # detached PDS4 and PDS3 labels
+bundle_workers = 4 # bundle file lists fetched concurrently by get_label_urls
+bundle_ttl = 3600 # seconds the labels found in a bundle file list are memoised
+
+# labels found in each bundle, keyed by bundle ID
+_bundles = {}
+_bundles_lock = threading.Lock()
+
+label_workers = 8 # labels fetched concurrently by iter_labels and download_labels
+lid_batch = 200 # LIDs resolved per EPN-TAP query
+
 
 def download_label_by_granule_uid(granule_uid, output_dir='.'):
     """
@@ -35,7 +62,7 @@ def download_label_by_granule_uid(granule_uid, output_dir='.'):
 
 
 
-def download_file(url, output_dir='.', output_file=None):
+def download_file(url, output_dir='.', output_file=None, session=None, retries=download_retries):
     """
     Downloads the file specified by url to the local directory specified
     by output_dir.
@@ -43,23 +70,117 @@ def download_file(url, output_dir='.', output_file=None):
     If output_file is set, this wil be used as the output filename.
     If output_file is None, an attempt will be made to get the filename
     from the content-disposition header.
+
+    If session is None the shared session from transport.get_session is used.
+
+    Data are written to a .part file which is renamed once the transfer
+    is complete. If the transfer is interrupted it is resumed (up to retries
+    times) with a Range request, and a .part file left by an earlier call
+    is resumed in the same way. If the server does not honour the Range
+    request the transfer restarts from the beginning.
     """
     
+    local_filename, validators = _download(url, output_dir, output_file, session, retries)
+
+    return local_filename
+
+
+def _download(url, output_dir='.', output_file=None, session=None, retries=download_retries):
+    """
+    Implements download_file, returning the local filename and a dictionary
+    of the size, ETag and Last-Modified values of the remote file
+    """
+
     path = pathlib.Path(output_dir)
     path.mkdir(parents=True, exist_ok=True)
 
-    with requests.get(url, stream=True) as r:
+    http = transport.get_session() if session is None else session
+
+    attempt = 0
+    while True:
+        try:
+            local_filename, headers = _fetch(http, url, output_dir, output_file)
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as err:
+            attempt += 1
+            if attempt > retries:
+                raise
+            log.warning('transfer of {:s} interrupted ({:s}), resuming'.format(url, str(err)))
+
+    log.debug('downloaded file {:s}'.format(os.path.basename(local_filename)))
+
+    validators = {
+        'size': os.path.getsize(local_filename),
+        'etag': headers.get('etag'),
+        'last_modified': headers.get('last-modified')}
+
+    return local_filename, validators
+
+
+def _fetch(http, url, output_dir, output_file=None):
+    """
+    Performs a single transfer attempt for download_file, appending to
+    any existing .part file and renaming it to the final name when done.
+    Returns the local filename and the response headers.
+    """
+
+    def part_file(filename):
+        return os.path.join(output_dir, filename + '.part')
+
+    def part_size(filename):
+        return os.path.getsize(part_file(filename)) if os.path.exists(part_file(filename)) else 0
+
+    def get(filename=None, offset=0):
+        headers = {'Range': 'bytes={:d}-'.format(offset)} if offset > 0 else {}
+        r = http.get(url, stream=True, headers=headers)
+        if r.status_code == 416:
+            # the .part file does not match the remote file, start again
+            r.close()
+            os.remove(part_file(filename))
+            r = http.get(url, stream=True)
         r.raise_for_status()
-        if output_file is None:
+        return r
+
+    if output_file is None:
+        r = get()
+        try:
             filename = get_filename_from_cd(r.headers.get('content-disposition'))
-        else:
-            filename = output_file
+            # the filename is only known now, so re-request the remainder if needed
+            if part_size(filename) > 0 and r.headers.get('accept-ranges', '').lower() != 'none':
+                r.close()
+                r = get(filename, part_size(filename))
+        except:
+            r.close()
+            raise
+    else:
+        filename = output_file
+        r = get(filename, part_size(filename))
+
+    try:
         local_filename = os.path.join(output_dir, filename)
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192): 
+
+        if r.status_code == 206:
+            log.info('resuming download of {:s} from byte {:d}'.format(filename, part_size(filename)))
+            mode = 'ab'
+        else:
+            mode = 'wb'
+
+        expected = r.headers.get('content-length')
+        received = 0
+        with open(part_file(filename), mode) as f:
+            for chunk in r.iter_content(chunk_size=download_chunk_size):
                 f.write(chunk)
-    log.debug('downloaded file {:s}'.format(filename))
-    return local_filename
+                received += len(chunk)
+
+        if expected is not None and received < int(expected):
+            raise requests.exceptions.ChunkedEncodingError('received {:d} of {:s} bytes'.format(received, expected))
+    finally:
+        r.close()
+
+    os.replace(part_file(filename), local_filename)
+
+    return local_filename, r.headers
 
 
 def get_filename_from_cd(cd):
@@ -75,66 +196,338 @@ def get_filename_from_cd(cd):
     return fname[0].strip('\"')
 
 
-def download_by_lid(lid, output_dir='.', unzip=True, tidy=True):
+def download_by_lid(lid, output_dir='.', unzip=True, tidy=True, workers=download_workers, mirror=False, stream=False):
 
     query = "select access_url, granule_uid from epn_core where granule_uid like '%%{:s}%%'".format(lid)
-    files = download_by_query(query, output_dir, tidy)
+    files = download_by_query(query, output_dir, unzip=unzip, tidy=tidy, workers=workers, mirror=mirror, stream=stream)
     return files
 
 
 
-def download_by_query(query, output_dir='.', unzip=True, tidy=True):
+def download_by_query(query, output_dir='.', unzip=True, tidy=True, workers=download_workers, report=False,
+        mirror=False, stream=False):
     """
     Runs a query against the PSA's EPN-TAP interface. Any products which match,
     and are public (have a download URL) will be downloaded and the zips placed
     into output_dir. If unzip=True they will be unzipped into output_dir and
-    if tidy=True the zips will be removed after use
-    """
+    if tidy=True the zips will be removed after use.
 
-    from zipfile import ZipFile
+    Up to workers products are downloaded concurrently. If report=True a
+    DataFrame with the status of each product is returned with the file list.
+    If mirror=True only new or changed products are fetched, and if stream=True
+    zips are extracted without being written to disk (see download_products).
+    """
 
     psa_tap = tap.PsaTap()
 
+    products = psa_tap.query(query)
+    if products is None:
+        log.error('no products matching query')
+        return ([], None) if report else []
+
+    files, status = download_products(products, output_dir=output_dir, unzip=unzip, tidy=tidy, workers=workers,
+        mirror=mirror, stream=stream)
+
+    return (files, status) if report else files
+
+
+def download_products(products, output_dir='.', unzip=True, tidy=True, workers=download_workers, resume=True,
+        mirror=False, check_remote=True, stream=False):
+    """
+    Accepts a DataFrame as returned by psa_tap.query, which must contain the
+    granule_uid and access_url columns, and downloads every public product
+    to output_dir using up to workers concurrent transfers over a shared
+    connection pool. Zips are unzipped (if unzip=True) as soon as their
+    transfer completes, while the remaining transfers continue, and removed
+    afterwards if tidy=True.
+
+    Progress is recorded in a journal in output_dir. If resume=True and a
+    previous batch was interrupted, products it completed are not fetched
+    again and partial transfers continue from where they stopped. The
+    journal is removed once every product has been downloaded.
+
+    If mirror=True the granule_uid, access_url, size, ETag and Last-Modified
+    of each product fetched are kept in a state file in output_dir, and
+    products already fetched whose files are still present are skipped. With
+    check_remote=True a HEAD request is made for these products and they are
+    fetched again if the size, ETag or Last-Modified reported has changed.
+
+    If stream=True each zip is received into a buffer of up to spool_size bytes
+    in memory (larger zips spill to a temporary file) and extracted from there
+    by the worker, so the zip itself is never written to output_dir. Streamed
+    transfers are retried from the start rather than resumed. This requires
+    unzip=True, and implies tidy=True.
+
+    Returns the list of files and a DataFrame with one row per product
+    giving its status (downloaded, resumed, unchanged, proprietary or
+    failed), the local zip and any error message.
+    """
+
+    from zipfile import ZipFile
+
     if tidy and not unzip:
         log.warning('cannot remove source files without decompressiong - setting tidy=False')
         tidy = False
 
-    files = []
+    if stream and not unzip:
+        log.warning('cannot stream products without decompressing - setting stream=False')
+        stream = False
 
-    products = psa_tap.query(query)
-    if products is None:
-        log.error('no products matching query')
     if ('granule_uid' not in products.columns) or ('access_url' not in products.columns):
         log.error('queries have to return granule_uid and access_url for product download')
         raise ValueError
-    for idx, product in products.iterrows():
-        product_id = tap.product_id_from_granule_uid(product.granule_uid)
-        if product.access_url == '':
-            log.warning('skipping proprietary product {:s}'.format(product_id))
-            continue
-        else:
-            log.info('downloading product {:s}'.format(product_id))
+
+    os.makedirs(output_dir, exist_ok=True)
+    journal_file = os.path.join(output_dir, download_journal)
+    journal = read_journal(journal_file) if resume else {}
+    state_file = os.path.join(output_dir, sync_state)
+    state = read_state(state_file) if mirror else {}
+
+    files = []
+    status = []
+    session = transport.get_session()
+    if workers > transport.pool_size:
+        log.warning('more workers than pooled connections, use transport.configure(pool_size=) to increase')
+
+    # streamed products are extracted by the workers, one at a time
+    extract_lock = threading.Lock()
+
+    def transfer(product, entry):
+        # returns None if the mirrored copy of the product is still current
+        if entry is not None:
+            if not check_remote or not remote_changed(product.access_url, entry, session):
+                return None
+        if stream:
+            return _stream_extract(product.access_url, output_dir, session=session, lock=extract_lock)
+        return _download(product.access_url, output_dir=output_dir, session=session)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(journal_file, 'a' if resume else 'w') as jf:
+
+        def record(product, stage, **kwargs):
+            entry = {'access_url': product.access_url, 'granule_uid': product.granule_uid, 'status': stage}
+            entry.update(kwargs)
+            jf.write(json.dumps(entry) + '\n')
+            jf.flush()
+
+        futures = {}
+        for idx, product in products.iterrows():
+            product_id = tap.product_id_from_granule_uid(product.granule_uid)
+            if product.access_url == '':
+                log.warning('skipping proprietary product {:s}'.format(product_id))
+                status.append({'product_id': product_id, 'granule_uid': product.granule_uid,
+                    'status': 'proprietary', 'local_file': None, 'error': None})
+                continue
+
+            entry = journal.get(product.access_url, {})
+            if entry.get('status') == 'done' and all(os.path.exists(f) for f in entry['files']):
+                log.info('product {:s} already downloaded, skipping'.format(product_id))
+                files.extend(entry['files'])
+                status.append({'product_id': product_id, 'granule_uid': product.granule_uid,
+                    'status': 'resumed', 'local_file': entry.get('local_file'), 'error': None})
+                if mirror:
+                    state[product.granule_uid] = dict(entry['validators'], access_url=product.access_url,
+                        local_file=entry['local_file'], files=entry['files'])
+                continue
+            elif entry.get('status') == 'downloaded' and os.path.exists(entry['local_file']):
+                # transferred but not yet unzipped
+                future = Future()
+                future.set_result((entry['local_file'], entry['validators']))
+            else:
+                mirrored = state.get(product.granule_uid)
+                if mirrored is not None:
+                    if mirrored['access_url'] != product.access_url or \
+                            not all(os.path.exists(f) for f in mirrored['files']):
+                        mirrored = None
+                if mirrored is None:
+                    log.info('downloading product {:s}'.format(product_id))
+                future = executor.submit(transfer, product, mirrored)
+            futures[future] = (product_id, product)
+
+        # unzip each product in this thread as it arrives, overlapping the other transfers
+        for future in as_completed(futures):
+            product_id, product = futures[future]
+            result = {'product_id': product_id, 'granule_uid': product.granule_uid,
+                'status': 'downloaded', 'local_file': None, 'error': None}
+            status.append(result)
+
+            local_file = None
             try:
-                local_file = download_file(product.access_url, output_dir=output_dir)
-                if not unzip:
-                    files.append(local_file)
-            except:
+                if future.result() is None:
+                    log.debug('product {:s} is unchanged, skipping'.format(product_id))
+                    result['status'] = 'unchanged'
+                    files.extend(state[product.granule_uid]['files'])
+                    continue
+                if stream:
+                    # already extracted by the worker
+                    product_files, validators = future.result()
+                    local_file = None
+                else:
+                    local_file, validators = future.result()
+                    result['local_file'] = local_file
+                    record(product, 'downloaded', local_file=local_file, validators=validators)
+                    if unzip:
+                        with ZipFile(local_file, 'r') as zipObj:
+                            zipObj.extractall(output_dir)
+                            product_files = [os.path.join(output_dir, f) for f in zipObj.namelist()]
+                    else:
+                        product_files = [local_file]
+            except Exception as err:
                 log.error('failure to download {:s}, skipping'.format(product_id))
+                result['status'] = 'failed'
+                result['error'] = str(err)
+                if local_file is not None:
+                    # the zip could not be extracted, so fetch it again rather than resuming it next time
+                    if os.path.exists(local_file):
+                        os.remove(local_file)
+                    record(product, 'failed', error=str(err))
                 continue
-                
-        if unzip:
-            with ZipFile(local_file, 'r') as zipObj:
-                zipObj.extractall(output_dir)
-                filelist = zipObj.namelist()
-                for f in filelist:
-                    files.append(os.path.join(output_dir, f))
 
-        if tidy:
-            os.remove(local_file)
+            if tidy and local_file is not None:
+                os.remove(local_file)
 
-        files = list(set(files))
+            files.extend(product_files)
+            record(product, 'done', local_file=local_file, validators=validators, files=product_files)
+
+            if mirror:
+                state[product.granule_uid] = dict(validators, access_url=product.access_url,
+                    local_file=local_file, files=product_files)
+
+    if mirror:
+        write_state(state_file, state)
+    files = list(set(files))
+    status = pd.DataFrame(status, columns=['product_id', 'granule_uid', 'status', 'local_file', 'error'])
+
+    if (status.status=='failed').any():
+        log.warning('{:d} products failed, re-run to resume the batch'.format((status.status=='failed').sum()))
+    else:
+        os.remove(journal_file)
+
+    log.info('downloaded {:d} of {:d} products'.format(status.status.isin(['downloaded', 'resumed']).sum(), len(status)))
+    if mirror:
+        log.info('{:d} products unchanged since the last download'.format((status.status=='unchanged').sum()))
+
+    return files, status
+
+
+def _stream_extract(url, output_dir='.', session=None, retries=download_retries, lock=None):
+    """
+    Receives the zip at url into a spooled buffer and extracts it into
+    output_dir, holding lock (if given) while extracting. Returns the list
+    of extracted files and the validators of the remote file, as _download.
+    """
+
+    from zipfile import ZipFile
+
+    http = transport.get_session() if session is None else session
+
+    attempt = 0
+    while True:
+        try:
+            with tempfile.SpooledTemporaryFile(max_size=spool_size) as spool:
+                with http.get(url, stream=True) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(chunk_size=download_chunk_size):
+                        spool.write(chunk)
+                    headers = r.headers
+                size = spool.tell()
+                spool.seek(0)
+                with lock if lock is not None else contextlib.nullcontext():
+                    with ZipFile(spool, 'r') as zipObj:
+                        zipObj.extractall(output_dir)
+                        product_files = [os.path.join(output_dir, f) for f in zipObj.namelist()]
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as err:
+            attempt += 1
+            if attempt > retries:
+                raise
+            log.warning('transfer of {:s} interrupted ({:s}), retrying'.format(url, str(err)))
+
+    validators = {
+        'size': size,
+        'etag': headers.get('etag'),
+        'last_modified': headers.get('last-modified')}
+
+    return product_files, validators
+
+
+def read_journal(journal_file):
+    """
+    Reads a download journal (a file of JSON records, one per line) and
+    returns a dictionary holding the latest record for each access URL
+    """
+
+    journal = {}
+    if not os.path.exists(journal_file):
+        return journal
+
+    with open(journal_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a record torn by the interruption
+                continue
+            journal[entry['access_url']] = entry
+
+    return journal
+
+def remote_changed(url, entry, session=None):
+    """
+    Makes a HEAD request for url and returns True if the size, ETag or
+    Last-Modified reported differ from those recorded in entry (as kept
+    in the mirror state). If the request fails the file is assumed to
+    have changed.
+    """
+
+    http = transport.get_session() if session is None else session
+
+    try:
+        r = http.head(url, allow_redirects=True)
+        r.raise_for_status()
+    except requests.exceptions.RequestException as err:
+        log.warning('could not check {:s} ({:s}), assuming changed'.format(url, str(err)))
+        return True
+
+    remote = {
+        'size': r.headers.get('content-length'),
+        'etag': r.headers.get('etag'),
+        'last_modified': r.headers.get('last-modified')}
+    if remote['size'] is not None:
+        remote['size'] = int(remote['size'])
+
+    # only compare what both the server and the state actually hold
+    for key, value in remote.items():
+        if value is not None and entry.get(key) is not None and value != entry[key]:
+            return True
+
+    return False
+
+
+def read_state(state_file):
+    """
+    Reads the mirror state file, returning a dictionary keyed by granule_uid
+    """
+
+    if not os.path.exists(state_file):
+        return {}
+
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+def write_state(state_file, state):
+    """
+    Writes the mirror state, replacing the file atomically so that an
+    interruption cannot leave it truncated
+    """
+
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_file + '.tmp', state_file)
+
+    return
 
-    return files
 
 def download_labels_by_query(query, output_dir='.'):
 
@@ -146,97 +539,316 @@ def download_labels_by_query(query, output_dir='.'):
     return
 
 
-def download_labels(epn_tap_df, output_dir='.'):
+def download_labels(epn_tap_df, output_dir='.', workers=label_workers):
     """Accepts a DataFrame as returned by psa_tap.query, uses 
     get_label_urls to add applicable URLs to the DataFrame and
-    then downloads each label to output_dir
+    then downloads the labels to output_dir, up to workers at a time.
+
+    Returns a DataFrame with one row per label URL giving its status
+    (downloaded or failed), the local file and any error message.
     """
     epn_tap_df = get_label_urls(epn_tap_df)
-    for idx, url in epn_tap_df.label_url.iteritems():
-        if url is None: # skip PDS3 or proprietary labels
-            continue
-        filename = os.path.basename(url)
-        download_file(url, output_dir=output_dir, output_file=filename)
+    urls = epn_tap_df.label_url.dropna() # skip PDS3 or proprietary labels
+
+    status = []
+    session = transport.get_session()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(download_file, url, output_dir=output_dir, output_file=os.path.basename(url),
+            session=session): url for url in urls}
+        for future in as_completed(futures):
+            url = futures[future]
+            result = {'label_url': url, 'status': 'downloaded', 'local_file': None, 'error': None}
+            status.append(result)
+            try:
+                result['local_file'] = future.result()
+            except Exception as err:
+                log.error('failure to download label {:s}: {:s}'.format(url, str(err)))
+                result['status'] = 'failed'
+                result['error'] = str(err)
 
-    return
+    status = pd.DataFrame(status, columns=['label_url', 'status', 'local_file', 'error'])
+    if (status.status=='failed').any():
+        log.warning('{:d} of {:d} labels failed to download'.format((status.status=='failed').sum(), len(status)))
+
+    return status
 
-def get_label_urls(epn_tap_df):
+def get_label_urls(epn_tap_df, workers=bundle_workers):
     """Accepts a DataFrame as returned by psa_tap.query, filters for
     PDS4 products, and finds the unique bundles.
     
     For each bundle it retrieves the corresponding file list from PDAP
     and then adds the download URL for the label, returning the df.
 
+    Products are matched to the file list with an index on the product ID,
+    so the cost grows linearly with the size of the bundle. Products whose
+    label cannot be found, or is ambiguous, are kept with a label_url of
+    None and the reason in the label_error column.
+
+    The file lists of up to workers bundles are fetched concurrently, and
+    the labels found are memoised (see bundle_labels).
+
     Note that this will only work for detached labels!
     """
 
-    epn_tap_df['label_url'] = None
+    epn_tap_df = epn_tap_df[epn_tap_df.access_url != ''].copy() # remove proprietary entries
 
-    epn_tap_df['pds4'] = epn_tap_df.granule_uid.apply(
-            lambda uid: True if uid.startswith('urn:') else False)
+    epn_tap_df['label_url'] = None
+    epn_tap_df['label_error'] = None
 
-    epn_tap_df = epn_tap_df[epn_tap_df.access_url != ''] # remove proprietary entries
+    epn_tap_df['pds4'] = epn_tap_df.granule_uid.str.startswith('urn:')
 
     # add the bundle/dataset ID 
-    epn_tap_df['bundle'] = None
+    gid = epn_tap_df.granule_gid.str.split(':')
+    epn_tap_df['bundle'] = gid.str[0:4].str.join(':').where(epn_tap_df.pds4, gid.str[0])
+
+    uid = epn_tap_df.granule_uid.str.split(':')
+    product_ids = uid.str[-3].where(epn_tap_df.pds4, uid.str[-1])
 
-    epn_tap_df.loc[epn_tap_df.pds4, 'bundle'] = epn_tap_df[epn_tap_df.pds4].granule_gid.apply(lambda uid: ':'.join(uid.split(':')[0:4]))
-    epn_tap_df.loc[~epn_tap_df.pds4, 'bundle'] = epn_tap_df[~epn_tap_df.pds4].granule_gid.apply(lambda uid: uid.split(':')[0])
-    
     psa_pdap = pdap.Pdap()
 
-    for bundle in epn_tap_df.bundle.unique():
+    bundles = epn_tap_df.bundle.unique()
+    if workers > transport.pool_size:
+        log.warning('{:d} workers exceeds the connection pool size of {:d}'.format(workers, transport.pool_size))
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(bundles)))) as executor:
+        listings = dict(zip(bundles, executor.map(lambda bundle: bundle_labels(bundle, psa_pdap), bundles)))
 
-        log.debug('querying files in bundle {:s}'.format(bundle))
-        files = psa_pdap.get_files(bundle)
+    for bundle, bundle_products in epn_tap_df.groupby('bundle', sort=False):
 
-        # loop through products from the query that are in this bundle
-        bundle_products = epn_tap_df[epn_tap_df.bundle==bundle]
-        for idx, product in bundle_products.iterrows():
-                product_id = tap.product_id_from_granule_uid(product.granule_uid)
-                product_files = files[files.ProductId==product_id].copy()
-                if len(product_files)==0:
-                    log.error('could not find product {:s} in bundle {:s}'.format(product_id, bundle))
-                    continue
+        ids = product_ids[bundle_products.index]
+        if listings[bundle] is None:
+            epn_tap_df.loc[ids.index, 'label_error'] = 'could not retrieve file list of bundle {:s}'.format(bundle)
+            continue
+        labels, products = listings[bundle]
 
-                # get the extensions to identify labels
-                product_files['ext'] = product_files.Filename.apply(lambda x: os.path.splitext(x)[-1])
-
-                # note that PDS3 attached labels will be skipped!
-                label_files = product_files[product_files.ext.str.lower().isin(['.xml','.lbl'])]
-                if len(label_files)==0:
-                    log.error('could not find label for product {:s}'.format(product_id))
-                    return None
-                elif len(label_files)>1:
-                    log.error('more than one file found for product {:s}'.format(product_id))
-                    return None
-                else:
-                    epn_tap_df.loc[idx, 'label_url'] = label_files.Reference.squeeze()
+        label_count = ids.map(labels.ProductId.value_counts()).fillna(0)
+        label_url = labels.drop_duplicates('ProductId', keep=False).set_index('ProductId').Reference
+
+        error = pd.Series(None, index=ids.index, dtype=object)
+        error[label_count == 0] = 'could not find label'
+        error[label_count > 1] = 'more than one label found'
+        error[products.get_indexer(ids) < 0] = 'could not find product in bundle {:s}'.format(bundle)
+
+        epn_tap_df.loc[ids.index, 'label_url'] = ids.map(label_url).astype(object).where(error.isna(), None)
+        epn_tap_df.loc[ids.index, 'label_error'] = error.where(error.notna(), None)
+
+        for product_id, message in zip(ids[error.notna()], error[error.notna()]):
+            log.error('{:s} for product {:s}'.format(message, product_id))
 
     return epn_tap_df
 
 
-def read_label_by_url(label_url):
+def bundle_labels(bundle, psa_pdap=None, ttl=bundle_ttl):
+    """Streams the file list of a bundle from PDAP and returns a tuple of
+    the ProductId, Filename and Reference of its label files, and an Index
+    of all product IDs in the bundle. Only these are kept, never the full
+    file list.
+
+    The result is memoised for ttl seconds (None to always query PDAP).
+    If the file list is broken off part way, None is returned and nothing is
+    memoised. Note that PDS3 attached labels are not found!"""
+
+    now = time.time()
+    with _bundles_lock:
+        if ttl is not None and bundle in _bundles:
+            created, listing = _bundles[bundle]
+            if now - created <= ttl:
+                log.debug('using memoised file list of bundle {:s}'.format(bundle))
+                return listing
+
+    psa_pdap = pdap.Pdap() if psa_pdap is None else psa_pdap
+    columns = ['ProductId', 'Filename', 'Reference']
+
+    log.debug('querying files in bundle {:s}'.format(bundle))
+    labels = []
+    products = []
+    try:
+        for chunk in psa_pdap.iter_files(bundle, columns=columns):
+            products.append(chunk.ProductId.to_numpy(dtype=object))
+            labels.append(chunk[chunk.Filename.str.lower().str.endswith(label_extensions)])
+    except pdap.stream_errors:
+        log.error('file list of bundle {:s} is incomplete'.format(bundle))
+        return None
+
+    if len(labels) == 0: # a failed query, or an unknown bundle
+        return pd.DataFrame(columns=columns, dtype=str), pd.Index([], dtype=object)
+
+    listing = (
+        pd.concat(labels, ignore_index=True),
+        pd.Index(np.concatenate(products), dtype=object).unique()) # hashed once, then probed per product
+
+    with _bundles_lock:
+        _bundles[bundle] = (now, listing)
+
+    return listing
+
+
+def clear_bundles():
+    """Discards the memoised bundle labels, so that get_label_urls queries
+    PDAP again"""
+
+    with _bundles_lock:
+        _bundles.clear()
+
+    return
+
+
+def read_label_by_url(label_url, session=None):
     """Parses a PDS4 label into memory given its URL"""
 
+    session = transport.get_session() if session is None else session
+
     try:
-        response = requests.get(label_url)
-        root = etree.fromstring(bytes(response.text, encoding='utf-8'))
-    except:
-        log.error('problem retrieving label')
-        # todo check exceptions raised here
+        response = session.get(label_url)
+        response.raise_for_status()
+        root = etree.fromstring(response.content)
+    except (requests.exceptions.RequestException, etree.XMLSyntaxError) as err:
+        log.error('problem retrieving label {:s} ({:s})'.format(label_url, str(err)))
+        return None
 
     return root
 
 
 def read_label_by_lid(lid):
 
-    query = "select access_url, granule_gid, granule_uid from epn_core where granule_uid like '%%{:s}%%'".format(lid)
+    for lidvid, root in iter_labels([lid], workers=1):
+        return root
+
+    return None
+
+
+def label_lidvid(root):
+    """Returns the LIDVID given in the Identification_Area of a PDS4 label"""
+
+    lid = root.findtext('{*}Identification_Area/{*}logical_identifier')
+    vid = root.findtext('{*}Identification_Area/{*}version_id')
+    if lid is None or vid is None:
+        return None
+
+    return '{:s}::{:s}'.format(lid.strip(), vid.strip())
+
+
+def get_label_urls_by_lid(lids):
+    """Accepts a list of PDS4 LIDs and/or LIDVIDs, and returns the
+    DataFrame of get_label_urls for the matching products, with the
+    granule_uid (LIDVID) of each. Where only the LID is given, the latest
+    version in EPN-TAP is used. Products are looked up lid_batch at a time,
+    each batch in a single EPN-TAP query."""
+
     psa_tap = tap.PsaTap()
-    products = psa_tap.query(query)
-    products = get_label_urls(products)
-    root = read_label_by_url(products.label_url.squeeze())
+    products = []
+
+    for start in range(0, len(lids), lid_batch):
+        conditions = []
+        for lid in lids[start:start + lid_batch]:
+            lid = lid.replace("'", "''")
+            if '::' in lid:
+                conditions.append("granule_uid = '{:s}'".format(lid))
+            else:
+                conditions.append("granule_uid LIKE '{:s}::%'".format(lid))
+        query = 'select access_url, granule_gid, granule_uid from epn_core where {:s}'.format(' OR '.join(conditions))
+        result = psa_tap.query(query)
+        if result is not None:
+            products.append(result)
+
+    products = pd.concat(products, ignore_index=True) if products else pd.DataFrame()
+
+    # LIKE treats _ as a wildcard, so drop any products matched by mistake
+    if len(products) > 0:
+        products = products.drop_duplicates('granule_uid').assign(lid=products.granule_uid.str.split('::').str[0])
+        products = products[products.lid.isin(lids) | products.granule_uid.isin(lids)]
+    if len(products) == 0:
+        log.error('no products found for the given LIDs')
+        return None
 
-    return root
+    # keep only the latest version of products requested by LID alone
+    by_lid = products.lid.isin(lids) & ~products.granule_uid.isin(lids)
+    latest = pdap.latest_mask(products.lid, products.granule_uid.str.split('::').str[-1])
+    products = products[~by_lid | latest].drop(columns=['lid'])
+
+    return get_label_urls(products.reset_index(drop=True))
+
+
+def iter_labels(labels, workers=label_workers, cache=None):
+    """Accepts a list of label URLs or PDS4 LIDs/LIDVIDs and fetches the
+    labels, up to workers at a time, yielding (lidvid, root) tuples as each
+    label is parsed. LIDs are resolved with get_label_urls_by_lid.
+
+    Labels are parsed directly from the response bytes. If cache is a
+    cache.LabelCache, labels are stored in it by LIDVID, and labels already
+    there are not fetched again. LIDVIDs found in the cache are not looked
+    up at all, so only the others (and bare LIDs, whose latest version must
+    be resolved) cost an EPN-TAP query and PDAP file list. For labels given
+    by URL the LIDVID is not known in advance, so these are always fetched.
+
+    If a label cannot be retrieved or parsed, an error is logged and
+    (lidvid, None) is yielded, with the URL in place of an unknown LIDVID."""
+
+    urls = [label for label in labels if label.startswith(('http://', 'https://'))]
+    lids = [label for label in labels if not label.startswith(('http://', 'https://'))]
+
+    def cached(lidvid):
+        content = cache.get(lidvid) if cache is not None else None
+        if content is None:
+            return None
+        try:
+            return etree.fromstring(content)
+        except etree.XMLSyntaxError:
+            return None
+
+    # LIDVIDs already cached need not be resolved to a URL
+    unresolved = []
+    for lid in lids:
+        root = cached(lid) if '::' in lid else None
+        if root is None:
+            unresolved.append(lid)
+        else:
+            yield lid, root
+
+    pending = [(None, url) for url in urls]
+    if len(unresolved) > 0:
+        missed = set(unresolved) # LIDVIDs already looked up in the cache
+        products = get_label_urls_by_lid(unresolved)
+        if products is not None:
+            products = products[products.label_url.notna()]
+            for lidvid, url in zip(products.granule_uid, products.label_url):
+                # a bare LID may resolve to a LIDVID which is cached
+                root = cached(lidvid) if lidvid not in missed else None
+                if root is None:
+                    pending.append((lidvid, url))
+                else:
+                    yield lidvid, root
+
+    def fetch(url):
+        response = session.get(url)
+        response.raise_for_status()
+        return response.content, etree.fromstring(response.content)
+
+    session = transport.get_session()
+    workers = max(1, workers)
+    pending = collections.deque(pending)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        # keep a bounded number of labels in flight, so that they do not
+        # accumulate in memory if the caller is slower than the downloads
+        futures = {}
+        while pending or futures:
+            while pending and len(futures) < 2 * workers:
+                lidvid, url = pending.popleft()
+                futures[executor.submit(fetch, url)] = (lidvid, url)
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                lidvid, url = futures.pop(future)
+                try:
+                    content, root = future.result()
+                except (requests.exceptions.RequestException, etree.XMLSyntaxError) as err:
+                    log.error('problem retrieving label {:s} ({:s})'.format(url, str(err)))
+                    yield (url if lidvid is None else lidvid), None
+                    continue
 
+                lidvid = label_lidvid(root) if lidvid is None else lidvid
+                if cache is not None and lidvid is not None:
+                    cache.put(lidvid, content)
+                yield (url if lidvid is None else lidvid), root
 
+    return
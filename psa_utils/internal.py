@@ -11,12 +11,12 @@ PSA internal members (archive scientists etc.)
 from socket import TCP_NODELAY
 from tarfile import HeaderError
 from . import common
+from . import compress
 from . import packager
 from . import tap
 import pathlib
 import logging
 import datetime
-import tarfile
 import copy
 from lxml import etree
 from lxml import html
@@ -27,7 +27,14 @@ import pandas as pd
 import datetime
 import yaml
 import os
+import time
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None # no reflinks outside unix
 
 log = logging.getLogger(__name__)
 
@@ -40,14 +47,40 @@ proc_levels = {
     'der': ('Derived', 'derived')
 }
 
+test_workers = 4 # test products generated concurrently by Ingest_Test
+FICLONE = 0x40049409 # ioctl cloning a file on Linux filesystems with reflinks (btrfs, xfs)
+
+# the fields of the test product template set by Ingest_Test
+test_product_fields = {
+    'logical_identifier': '//pds:Identification_Area/pds:logical_identifier',
+    'version_id': '//pds:Identification_Area/pds:version_id',
+    'modification_date': '//pds:Identification_Area/pds:Modification_History/pds:Modification_Detail/pds:modification_date',
+    'instrument_lid_reference': "//pds:Observing_System_Component[pds:type='Instrument']/pds:Internal_Reference/pds:lid_reference",
+    'instrument_name': "//pds:Observing_System_Component[pds:type='Instrument']/pds:name",
+    'investigation_lid_reference': "//pds:Investigation_Area/pds:Internal_Reference[pds:reference_type='data_to_investigation']/pds:lid_reference",
+    'file_name': '//pds:File_Area_Observational/pds:File/pds:file_name',
+    'processing_level': '//pds:Primary_Result_Summary/pds:processing_level',
+    'mission_area': '//pds:Mission_Area'}
+
 class Ingest_Test():
     """A class for generating test products from a label and data product
     template and a configuration file specifying the instrument-specific
-    data"""
+    data. Products are generated on a pool of workers threads, and
+    the data file of each is a reflink of the template data file where
+    the filesystem supports it, and otherwise a copy (always a copy if
+    link=False). With hard_link=True a hard link is tried before copying,
+    but the test data files then share the template data file. The time
+    taken for each product, and how its data file was made, are given in
+    self.timings"""
 
-    def __init__(self, config_file='ingestion_test.yml', template_label='test_product.xml', output_dir='.', package=False, lblx=False):
+    def __init__(self, config_file='ingestion_test.yml', template_label='test_product.xml', output_dir='.', package=False, lblx=False,
+        workers=test_workers, link=True, hard_link=False):
 
         self.lblx=lblx
+        self.workers = workers
+        self.link = link
+        self.hard_link = hard_link
+        self.timings = None
 
         # read the configuration file
         self.read_config(config_file)
@@ -88,17 +121,21 @@ class Ingest_Test():
 
 
     def load_template(self, template_label):
+        """Parses the template label, once, and compiles the XPath of each of
+        test_product_fields for its namespaces into self.xpaths"""
 
         self.label = pathlib.Path(template_label)
         if not self.label.exists():
             log.error('could not open template file {:s}'.format(self.label.name))
             self.label = None
+            return
 
         self.tree = etree.parse(template_label)
         ns = self.tree.getroot().nsmap
         if None in ns and common.pds_ns == ns[None]:
             ns['pds'] = ns.pop(None)
         self.ns = ns
+        self.xpaths = {name: etree.XPath(path, namespaces=self.ns) for name, path in test_product_fields.items()}
 
 
     def generate_products(self, output_dir):
@@ -118,17 +155,22 @@ class Ingest_Test():
             return product_id
 
 
-        def copy_data_file(root, output_dir):
+        def copy_data_file(root, output_dir, product_id):
 
-            # copy and rename the template data product
-            data_name = root.xpath("//pds:File_Area_Observational/pds:File/pds:file_name", namespaces=self.ns)[0].text
+            # link (or copy) and rename the template data product
+            data_name = self.xpaths['file_name'](root)[0].text
             data_file = pathlib.Path(os.path.join(self.label.parent.absolute(), data_name))
             if not data_file.exists():
                 log.error('could not open data file file {:s}'.format(data_name))
-                return None
-            shutil.copy(data_file, os.path.join(output_dir, product_id + data_file.suffix))
+                return None, None
+            destination = os.path.join(output_dir, product_id + data_file.suffix)
+            if self.link:
+                method = link_file(data_file, destination, hard_link=self.hard_link)
+            else:
+                shutil.copy(data_file, destination)
+                method = 'copy'
 
-            return data_file
+            return data_file, method
 
         def update_template(root, bundle, product_id, level, data_file, sub_inst=None):
 
@@ -143,18 +185,18 @@ class Ingest_Test():
             
             today = datetime.datetime.today()
             
-            agency_prefix = ':'.join(root.xpath('//pds:Identification_Area/pds:logical_identifier', namespaces=self.ns)[0].text.split(':')[0:3])
+            agency_prefix = ':'.join(self.xpaths['logical_identifier'](root)[0].text.split(':')[0:3])
 
             # update the template with the mission/instrument-relevant values
 
-            root.xpath('//pds:Identification_Area/pds:logical_identifier', namespaces=self.ns)[0].text = '{:s}:{:s}:data_{:s}:{:s}'.format(agency_prefix, bundle, proc_levels[level][1], product_id)
-            root.xpath('//pds:Identification_Area/pds:version_id', namespaces=self.ns)[0].text = '1.{:d}{:02d}'.format(today.year, today.month)
-            root.xpath('//pds:Identification_Area/pds:Modification_History/pds:Modification_Detail/pds:modification_date', namespaces=self.ns)[0].text =today.strftime('%Y-%m-%d')
-            root.xpath("//pds:Observing_System_Component[pds:type='Instrument']/pds:Internal_Reference/pds:lid_reference", namespaces=self.ns)[0].text = '{:s}:context:instrument:{:s}.{:s}'.format(agency_prefix, host, instrument)
-            root.xpath("//pds:Observing_System_Component[pds:type='Instrument']/pds:name", namespaces=self.ns)[0].text = self.config[bundle]['fullname']
-            root.xpath("//pds:Investigation_Area/pds:Internal_Reference[pds:reference_type='data_to_investigation']/pds:lid_reference", namespaces=self.ns)[0].text = 'urn:esa:psa:context:investigation:mission.{:s}'.format(mission)
-            root.xpath("//pds:File_Area_Observational/pds:File/pds:file_name", namespaces=self.ns)[0].text = product_id + data_file.suffix
-            root.xpath("//pds:Primary_Result_Summary/pds:processing_level", namespaces=self.ns)[0].text = proc_levels[level][0]
+            self.xpaths['logical_identifier'](root)[0].text = '{:s}:{:s}:data_{:s}:{:s}'.format(agency_prefix, bundle, proc_levels[level][1], product_id)
+            self.xpaths['version_id'](root)[0].text = '1.{:d}{:02d}'.format(today.year, today.month)
+            self.xpaths['modification_date'](root)[0].text =today.strftime('%Y-%m-%d')
+            self.xpaths['instrument_lid_reference'](root)[0].text = '{:s}:context:instrument:{:s}.{:s}'.format(agency_prefix, host, instrument)
+            self.xpaths['instrument_name'](root)[0].text = self.config[bundle]['fullname']
+            self.xpaths['investigation_lid_reference'](root)[0].text = 'urn:esa:psa:context:investigation:mission.{:s}'.format(mission)
+            self.xpaths['file_name'](root)[0].text = product_id + data_file.suffix
+            self.xpaths['processing_level'](root)[0].text = proc_levels[level][0]
             if sub_inst:
             
                     # Need to insert new sub-instrument class, e.g.:
@@ -167,7 +209,7 @@ class Ingest_Test():
                     # </psa:Sub-Instrument>
 
                     # find the Mission_Area
-                    mission = root.xpath('//pds:Mission_Area', namespaces=self.ns)[0]
+                    mission = self.xpaths['mission_area'](root)[0]
 
                     # create new elements, working down
                     sub = etree.SubElement(mission, '{{{:s}}}Sub-Instrument'.format(self.ns['psa']), nsmap=self.ns)
@@ -178,8 +220,9 @@ class Ingest_Test():
                     inst_type = etree.SubElement(sub, '{{{:s}}}type'.format(self.ns['psa']), nsmap=self.ns)
                     inst_type.text = self.config[bundle]['sub_instruments'][sub_inst]
 
-                    # insert the new sub-instrument element into the mission element
-                    mission.insert(idx, sub)
+                    # move the new sub-instrument element to follow the Mission_Information
+                    information = mission.find('{{{:s}}}Mission_Information'.format(self.ns['psa']))
+                    mission.insert(0 if information is None else mission.index(information) + 1, sub)
 
                     # TODO: handle instruments with multiple types, comma-separated in the yaml?
 
@@ -191,30 +234,72 @@ class Ingest_Test():
             label_out = os.path.join(output_dir, product_id + suffix)
             tree.write(label_out, xml_declaration=True, encoding=self.tree.docinfo.encoding) 
 
+        def generate_product(level, bundle, sub_inst):
+
+            start = time.perf_counter()
+            tree = copy.deepcopy(self.tree)
+            root = tree.getroot()
+            product_id = get_product_id(bundle, level, sub_instr=sub_inst)
+            data_file, method = copy_data_file(root, output_dir, product_id)
+            if data_file is None:
+                return None
+            root = update_template(root, bundle, product_id, level, data_file, sub_inst)
+            if root is None:
+                return None
+            write_label(tree, output_dir, product_id)
+
+            return (product_id, bundle, level, sub_inst, method, time.perf_counter() - start)
+
 #########################
 
+        products = []
         for level in proc_levels:
-
             for bundle in self.config:
-
                 if 'sub_instruments' in self.config[bundle].keys(): 
-                    for idx, sub_inst in enumerate(self.config[bundle]['sub_instruments']):
-                        tree = copy.deepcopy(self.tree)
-                        root = tree.getroot()
-                        product_id = get_product_id(bundle, level, sub_instr=sub_inst)
-                        data_file = copy_data_file(root, output_dir)
-                        if data_file is not None:
-                            root = update_template(root, bundle, product_id, level, data_file, sub_inst)
-                            write_label(tree, output_dir, product_id)
-
+                    products.extend((level, bundle, sub_inst) for sub_inst in self.config[bundle]['sub_instruments'])
                 else:
-                    tree = copy.deepcopy(self.tree)
-                    root = tree.getroot()
-                    product_id = get_product_id(bundle, level, sub_instr=None)
-                    data_file = copy_data_file(root, output_dir)
-                    if data_file is not None:
-                        root = update_template(root, bundle, product_id, level, data_file, None)
-                        write_label(tree, output_dir, product_id)
+                    products.append((level, bundle, None))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            results = list(executor.map(lambda product: generate_product(*product), products))
+
+        self.timings = pd.DataFrame([result for result in results if result is not None],
+            columns=['product_id', 'bundle', 'level', 'sub_instrument', 'method', 'time'])
+        log.info('{:d} test products generated in {:.2f} s ({:.1f} ms per product)'.format(
+            len(self.timings), time.perf_counter() - start, 1000. * self.timings.time.mean() if len(self.timings) else 0.))
+
+        return
+
+
+def link_file(source, destination, hard_link=False):
+    """Creates destination with the content of source without copying the
+    data where the filesystem allows: as a reflink (a copy-on-write clone),
+    otherwise as a hard link if hard_link=True (so that writing to either
+    changes both), and otherwise as a copy. Any existing destination is
+    replaced. Returns the method used: reflink, link or copy"""
+
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            if os.path.lexists(destination):
+                os.remove(destination)
+
+    if hard_link:
+        try:
+            os.link(source, destination)
+            return 'link'
+        except OSError:
+            pass
+
+    shutil.copy(source, destination)
+    return 'copy'
 
 
 def build_context_json(config_file, input_dir='.', output_dir='.', json_name='local_context_products.json', table='context_bundle'):
@@ -573,7 +658,7 @@ def deletion_request(query, dryrun=True, output_dir='.', make_private=False, pri
     else:
         product_list.to_csv(outfile, sep='\t', index=False, header=False)
         tarball = os.path.join(output_dir, deletion_name + '.tar.gz')
-        with tarfile.open(tarball, "w:gz") as tar:
+        with compress.open_tarball(tarball) as tar:
             tar.add(outfile, arcname=deletion_name + '.tab', recursive=False)
 
     return 
@@ -636,7 +721,7 @@ def set_proprietary_date(query, end_date=None, dryrun=True, output_dir='.',
         outfile = os.path.join(output_dir, update_name + '.tab')
         product_list.to_csv(outfile, sep='\t', index=False, header=False)
         tarball = os.path.join(output_dir, update_name + '.tar.gz')
-        with tarfile.open(tarball, "w:gz") as tar:
+        with compress.open_tarball(tarball) as tar:
             tar.add(outfile, arcname=update_name + '.tab', recursive=False)
 
 
@@ -7,30 +7,68 @@ Packages PDS4 products into a delivery package for ingestion into the PSA
 """
 
 from . import common
+from . import compress
 
 import os
+import re
+import copy
+import glob
+import json
+import time
+import threading
+import functools
+import contextlib
+import fnmatch
+import itertools
 import pathlib
 import datetime
 import numpy as np
 import pandas as pd
 import shutil
-import tarfile
 import hashlib
 from lxml import etree
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import logging
 log = logging.getLogger(__name__)
 
+hash_workers = min(8, os.cpu_count() or 1) # files hashed concurrently
+hash_block_size = 1024 * 1024 # bytes read at a time when hashing
+label_workers = 1 # processes parsing labels (if more than one, run under an if __name__ == '__main__' guard)
+label_chunk = 64 # labels parsed by a worker process at a time
+shard_workers = 2 # shards of a delivery built concurrently
+stream_chunk = 1000 # products indexed, checked and streamed at a time with chunk_size
+manifest_buffer_size = 1024 * 1024 # bytes buffered when writing manifests
+path_dir = '{0:s}[^{0:s}]*$'.format(re.escape(os.sep)) # matches the file name at the end of a path
+path_name = '^.*{:s}'.format(re.escape(os.sep)) # matches the directory at the start of a path
+
 try:
     from pds4_utils import dbase
+    from pds4_utils import common as pds4_common
 except ModuleNotFoundError:
     log.error('pds4_utils module not available, please install before using psa_utils.packager')
 
+
+def stage(function):
+    """
+    A decorator that records the wall time of a Packager stage, and the
+    counters added during it, in the StageStats of the Packager
+    """
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        with self.stats.stage(function.__name__, delivery=getattr(self, 'delivery_name', None)):
+            return function(self, *args, **kwargs)
+    return wrapper
+
+
 class Packager():
 
     def __init__(self, products='*.xml', input_dir='.', recursive=True, output_dir='.', template=None, 
         use_dir=False, clean=True, sendfrom=None, sendto=None, allow_missing=False, bundle_delivery=False,
-        priority=False):
+        priority=False, workers=hash_workers, stream=False, compression=None, compression_level=None,
+        fingerprints=None, max_products=None, max_bytes=None, shard_workers=shard_workers, chunk_size=None, trace=None,
+        label_workers=label_workers):
         """Initialise the packager class. Accepts the following:
 
         products - file pattern to match labels (*.xml default)
@@ -49,8 +87,38 @@ class Packager():
             (useful when packaging a collection label without inventory)
         bundle_delivery - if true, the bundle delivery flag is set
         priority - if true, high priority delivery will be created, otherwise standard
+        workers - number of files to checksum concurrently
+        stream - if True, products are written straight into the tarball and
+            hashed as they are read, without a staging copy (see stream_package)
+        compression - the compression backend (see compress.open_tarball),
+            or None for the compress module default. ValueError is raised
+            if this is not one of compress.backends
+        compression_level - gzip compression level (1-9), or None for the default
+        fingerprints - a cache.FingerprintCache holding label content and
+            checksums from earlier runs, so that unchanged files are not
+            parsed or hashed again (None to disable)
+        max_products - if set, the products are split into several delivery
+            packages (shards) of at most this many products each
+        max_bytes - if set, the products are split into shards whose labels
+            and data files total at most this many bytes (a product larger
+            than this is delivered alone)
+        shard_workers - number of shards built concurrently
+        chunk_size - if set, products are found, checked and streamed into the
+            tarball this many at a time, so that memory use does not grow
+            with the number of products (see stream_chunks)
+        trace - if given, the file to which the time, bytes read and written
+            and files processed by each stage are written as a JSON trace
+            (see StageStats.write_trace). These are always kept in self.stats
+        label_workers - number of processes parsing labels. With more than
+            one, the calling script must create the Packager under an
+            if __name__ == '__main__' guard where processes are spawned
+            (the default on Windows and macOS)
         """
 
+        if compression is not None and compression not in compress.backends:
+            log.error('compression backend must be one of: {:s}'.format(', '.join(compress.backends)))
+            raise ValueError
+
         self.products = products
         self.input_dir = input_dir
         self.recursive = recursive
@@ -61,77 +129,243 @@ class Packager():
         self.allow_missing = allow_missing
         self.delivery_type = 'D' if bundle_delivery else 'P'
         self.priority = priority
+        self.workers = workers
+        self.label_workers = label_workers
+        self.checksums = {} # MD5 checksums, keyed by absolute path
+        self.compression = compression
+        self.compression_level = compression_level
+        self.fingerprints = fingerprints
+        self.labels = {} # label content, keyed by filename
+        self.report = None
+        self.shards = None
+        self.stats = StageStats()
+
+        try:
+            self.run(template=template, clean=clean, sendfrom=sendfrom, sendto=sendto, stream=stream,
+                max_products=max_products, max_bytes=max_bytes, shard_workers=shard_workers, chunk_size=chunk_size)
+        finally:
+            if trace is not None:
+                self.stats.write_trace(trace)
+
+
+    def run(self, template=None, clean=True, sendfrom=None, sendto=None, stream=False, max_products=None,
+        max_bytes=None, shard_workers=shard_workers, chunk_size=None):
+        """Runs every stage needed to build the delivery package(s), as set
+        up by the constructor"""
+
+        if chunk_size is not None:
+            if max_products is not None or max_bytes is not None:
+                log.error('chunk_size cannot be combined with max_products or max_bytes')
+                return None
+            self.stream_chunks(chunk_size=chunk_size, sendfrom=sendfrom, sendto=sendto, template=template, clean=clean)
+            return
 
         # sequentially run everything we need to build the delivery package
         self.get_products()              # index the specified products, get bundle, collection, etc.
         if not self.check_products():    # sanity checks - >1 bundle? etc.
             log.error('product checks failed, aborting')
             return None
-        self.get_delivery_name(sendfrom, sendto)         # build the delivery package name
+        if max_products is not None or max_bytes is not None:
+            self.build_shards(max_products=max_products, max_bytes=max_bytes, workers=shard_workers,
+                sendfrom=sendfrom, sendto=sendto, template=template, clean=clean, stream=stream)
+            return
+        self.build(sendfrom=sendfrom, sendto=sendto, template=template, clean=clean, stream=stream)
+
+
+    def build(self, sendfrom=None, sendto=None, template=None, clean=True, stream=False, delivery_time=None):
+        """Builds the delivery package of the indexed (and checked) products.
+        delivery_time is used to name the package, if None the current time"""
+
+        self.get_delivery_name(sendfrom, sendto, delivery_time)         # build the delivery package name
 
         self.package_dir = os.path.join(self.output_dir, self.delivery_name)
         os.makedirs(self.package_dir, exist_ok=True)
 
         self.build_paths()               # build delivery paths, according to use_dir
         self.create_transfer_manifest()  # create the transfer manifest .tab file
+        if stream:
+            self.stream_package(template=template, clean=clean) # tar and hash products, then add manifests and label
+            return
         self.create_checksum_manifest()  # create the checksum manifest
         self.create_label(template=template)              # flesh out the template PDS4 label
         self.create_package(clean=clean)            # copy files into correct structure and build tarball
 
 
+    @stage
     def get_products(self):
         """Obtain the list of products to be packaged and also list data products"""
 
-        self.index = dbase.index_products(directory=self.input_dir, pattern=self.products, recursive=self.recursive)
+        if self.fingerprints is None:
+            self.index = dbase.index_products(directory=self.input_dir, pattern=self.products, recursive=self.recursive)
+        else:
+            self.index = self.index_products()
         self.index['lidvid'] = self.index.lid + '::' + self.index.vid
+        self.stats.add(files=len(self.index))
+
+
+    def index_products(self, filenames=None):
+        """Builds the same index as dbase.index_products, but using read_labels
+        so that unchanged labels are not parsed again. If filenames is None,
+        all labels matching self.products are indexed"""
+
+        if filenames is None:
+            filenames = pds4_common.select_files(self.products, directory=self.input_dir, recursive=self.recursive)
+        labels = self.read_labels(filenames)
+
+        cols = ['filename', 'product_type', 'lid', 'vid', 'start_time', 'stop_time']
+        index = []
+        for filename in filenames:
+            label = labels[filename]
+            if 'error' in label:
+                log.error('could not read label {:s}: {:s}'.format(filename, label['error']))
+                continue
+            if not label['product_type'].startswith('Product_'):
+                log.warning('XML file {:s} is not a PDS4 label, skipping'.format(pathlib.Path(filename).name))
+                continue
+            index.append(dict(label, filename=filename))
+
+        index = pd.DataFrame(index, columns=cols)
+
+        index['bundle'] = index.lid.apply(lambda x: x.split(':')[3])
+        index['collection'] = index.lid.apply(lambda x: x.split(':')[4] if len(x.split(':'))>4 else None)
+        index['product_id'] = index.lid.apply(lambda x: x.split(':')[-1])
+
+        # make sure timestamps are stripped of timezones
+        index.start_time = pd.to_datetime(index.start_time).dt.tz_localize(None)
+        index.stop_time = pd.to_datetime(index.stop_time).dt.tz_localize(None)
 
+        log.info('{:d} PDS4 labels indexed'.format(len(index)))
 
+        return index
+
+
+    def iter_filenames(self):
+        """Yields the labels matching self.products under self.input_dir, as
+        select_files would list them but one directory at a time, sorted
+        within each directory"""
+
+        if not self.recursive:
+            yield from sorted(glob.glob(os.path.join(self.input_dir, self.products)))
+            return
+
+        for path, dirs, files in os.walk(os.path.abspath(self.input_dir)):
+            dirs.sort()
+            for filename in sorted(fnmatch.filter(files, self.products)):
+                yield os.path.join(path, filename)
+
+
+    @stage
+    def read_labels(self, filenames):
+        """Returns a dictionary of filename: label content (as given by
+        parse_label) for the given labels. Labels already read in this run,
+        or unchanged since they were stored in self.fingerprints, are not
+        parsed again; the rest are parsed on a pool of self.label_workers
+        processes, or in this process if the pool cannot be started"""
+
+        labels = {filename: self.labels[filename] for filename in filenames if filename in self.labels}
+        remaining = [filename for filename in filenames if filename not in labels]
+
+        if self.fingerprints is not None:
+            for filename in remaining:
+                label = self.fingerprints.get_label(filename)
+                if label is not None:
+                    labels[filename] = label
+            remaining = [filename for filename in remaining if filename not in labels]
+
+        parsed = None
+        if self.label_workers > 1 and len(remaining) > label_chunk:
+            try:
+                with ProcessPoolExecutor(max_workers=self.label_workers) as executor:
+                    parsed = list(executor.map(parse_label, remaining, chunksize=label_chunk))
+            except BrokenProcessPool as err:
+                log.warning('label parsing pool failed ({:s}), parsing labels in this process'.format(str(err)))
+
+        if parsed is None:
+            parsed = [parse_label(filename) for filename in remaining]
+
+        for filename, label in zip(remaining, parsed):
+            labels[filename] = label
+            if self.fingerprints is not None and 'error' not in label:
+                self.fingerprints.put_label(filename, label)
+        self.stats.add(files=len(remaining))
+
+        self.labels.update(labels)
+
+        return labels
+
+
+    @stage
     def check_products(self):
-        """Perform basic sanity checks"""
+        """Perform basic sanity checks. Every problem found is logged and
+        recorded in self.report, a DataFrame giving the filename, problem,
+        detail and whether the problem is fatal. Returns False if any is"""
 
-        bad_products = []
+        problems = []
 
         # check for products from multiple bundles
-        if len(self.index.bundle.unique()) > 1:
+        bundles = self.index.bundle.unique()
+        if len(bundles) > 1:
             log.error('cannot package products from more than one bundle - aborting!')
-            return False
+            problems.append((None, 'multiple bundles', ', '.join(bundles), True))
         else:
-            self.bundle = self.index.bundle.unique()[0]
+            self.bundle = bundles[0]
             self.mission = self.bundle.split('_')[0]
 
         # check for duplicate products
-        if self.index.duplicated('lidvid').sum() > 0:
+        duplicated = self.index[self.index.duplicated('lidvid', keep=False)]
+        if len(duplicated) > 0:
             log.error('duplicated product LIDVIDs in this package - aborting!')
-            return False
+            problems.extend((filename, 'duplicated LIDVID', lidvid, True) for filename, lidvid in zip(duplicated.filename, duplicated.lidvid))
+
+        # check that all referenced data files are present, listing each
+        # directory once rather than testing each file
+        labels = self.read_labels(self.index.filename.tolist())
+        listings = {}
+        bad_products = []
 
-        # check that all referenced data files are present
-        for idx, product in self.index.iterrows():
+        for idx, filename, lidvid in zip(self.index.index, self.index.filename, self.index.lidvid):
 
-            product_file = pathlib.Path(product.filename)
-            root = etree.parse(product.filename).getroot()
-                
-            ns = root.nsmap
-            if None in ns and common.pds_ns == ns[None]:
-                ns['pds'] = ns.pop(None)
+            product_file = pathlib.Path(filename)
+            label = labels[filename]
+
+            if 'error' in label:
+                log.error('could not read label {:s}: {:s}'.format(product_file.name, label['error']))
+                problems.append((filename, 'unreadable label', label['error'], True))
+                continue
 
-            product_type = root.xpath('name(/*)', namespaces=ns)
-            if not product_type.startswith('Product_'):
+            if not label['product_type'].startswith('Product_'):
                 log.warning('XML file {:s} is not a PDS4 label, skipping'.format(product_file.name))
+                problems.append((filename, 'not a PDS4 label', label['product_type'], False))
                 bad_products.append(idx)
                 continue
 
-            # data_files =  root.xpath('//pds:File/pds:file_name', namespaces=ns)
-            data_files =  root.xpath('//pds:file_name', namespaces=ns)
+            directory = str(product_file.parent)
+            if directory not in listings:
+                listings[directory] = set(os.listdir(directory))
+
             missing_files = []
-            for data_file in data_files:
-                if not pathlib.Path(os.path.join(product_file.parent, data_file.text)).exists():
-                    if self.allow_missing:
-                        log.warning('cannot find data file {:s} referenced in product {:s}!'.format(data_file.text, product_file.name))
-                        missing_files.append(data_file)
-                    else:
-                        log.error('cannot find data file {:s} referenced in product {:s}, aborting!'.format(data_file.text, product_file.name))
-                        return False
-            self.data_files.update( {product.lidvid: [f.text for f in data_files if f not in missing_files]})
+            for data_file in label['data_files']:
+                if data_file in listings[directory] or os.path.exists(os.path.join(directory, data_file)):
+                    continue
+                missing_files.append(data_file)
+                if self.allow_missing:
+                    log.warning('cannot find data file {:s} referenced in product {:s}!'.format(data_file, product_file.name))
+                else:
+                    log.error('cannot find data file {:s} referenced in product {:s}!'.format(data_file, product_file.name))
+                problems.append((filename, 'missing data file', data_file, not self.allow_missing))
+
+            self.data_files.update( {lidvid: [f for f in label['data_files'] if f not in missing_files]})
+
+        self.report = pd.DataFrame(problems, columns=['filename', 'problem', 'detail', 'fatal'])
+        self.stats.add(files=len(self.index))
+
+        if self.fingerprints is not None:
+            self.fingerprints.commit()
+
+        if self.report.fatal.any():
+            log.error('{:d} problems found, see Packager.report - aborting!'.format(self.report.fatal.sum()))
+            return False
+
         if len(bad_products)>0:
             log.warning('{:d} products removed as invalid'.format(len(bad_products)))
             self.index.drop(bad_products, inplace=True)
@@ -139,9 +373,9 @@ class Packager():
         return True
         
 
-    def get_delivery_name(self, sendfrom=None, sendto=None):
+    def get_delivery_name(self, sendfrom=None, sendto=None, delivery_time=None):
 
-        self.delivery_time = datetime.datetime.now()
+        self.delivery_time = datetime.datetime.now() if delivery_time is None else delivery_time
 
         if sendfrom is None:
             # get mission acronym from bundle
@@ -159,28 +393,98 @@ class Packager():
         self.delivery_name = '{:s}{:s}-pds4-{:s}I-{:s}0-{:s}-{:s}'.format(sendfrom, sendto, self.delivery_type, priority_flag, self.bundle, self.delivery_time.strftime('%Y%m%dT%H%M%S'))
 
 
-    def build_paths(self):
+    def split(self, max_products=None, max_bytes=None):
+        """Splits the indexed products into consecutive groups of at most
+        max_products products and max_bytes bytes (of labels and data files),
+        returning a list of Packagers, one per group, which share the
+        settings, labels and checksums of this one"""
 
-        self.index['path'] = None
+        if max_products is not None and max_products < 1:
+            log.error('max_products must be at least 1')
+            return None
 
-        for idx, product in self.index.iterrows():
+        if max_bytes is None:
+            sizes = np.zeros(len(self.index), dtype=np.int64)
+        else:
+            sizes = np.array([os.path.getsize(filename) + sum(
+                os.path.getsize(os.path.join(os.path.dirname(filename), data_file)) for data_file in self.data_files[lidvid])
+                for filename, lidvid in zip(self.index.filename, self.index.lidvid)], dtype=np.int64)
+
+        # start a new shard whenever adding the next product would exceed either limit
+        shard = np.zeros(len(sizes), dtype=np.int64)
+        count, total = 0, 0
+        for i, size in enumerate(sizes):
+            if count > 0 and ((max_products is not None and count == max_products) or
+                    (max_bytes is not None and total + size > max_bytes)):
+                shard[i] = shard[i-1] + 1
+                count, total = 0, 0
+            elif i > 0:
+                shard[i] = shard[i-1]
+            count += 1
+            total += size
+
+        shards = []
+        for _, index in self.index.groupby(pd.Series(shard, index=self.index.index), sort=False):
+            packager = copy.copy(self)
+            packager.index = index.copy()
+            shards.append(packager)
+
+        return shards
+
+
+    def build_shards(self, max_products=None, max_bytes=None, workers=shard_workers, sendfrom=None, sendto=None,
+        template=None, clean=True, stream=False):
+        """Splits the products into shards (see split) and builds a delivery
+        package for each, up to workers at a time. Each package has its own
+        manifests and label, and is named with the delivery time advanced by
+        one second per shard, so that the names are unique. The shards are
+        kept in self.shards"""
+
+        shards = self.split(max_products=max_products, max_bytes=max_bytes)
+        if shards is None:
+            return None
 
-            label = pathlib.Path(product.filename)
+        log.info('splitting {:d} products into {:d} delivery packages'.format(len(self.index), len(shards)))
+        delivery_time = datetime.datetime.now().replace(microsecond=0)
 
-            if not self.use_dir:
-                # simply use the bundle/collection root
-                if product.product_type=='Product_Bundle':
-                    self.index.loc[idx, 'path'] = os.path.join(product.bundle, label.name)
-                else:
-                    self.index.loc[idx, 'path'] = os.path.join(product.bundle, product.collection, label.name)
-            else:
-                # use the path relative to the input directory
-                self.index.loc[idx, 'path'] = os.path.join(product.bundle, os.path.relpath(label, start=self.input_dir))
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(shards)))) as executor:
+            futures = [executor.submit(shard.build, sendfrom=sendfrom, sendto=sendto, template=template, clean=clean,
+                stream=stream, delivery_time=delivery_time + datetime.timedelta(seconds=i)) for i, shard in enumerate(shards)]
+            for future in futures:
+                future.result()
+
+        self.shards = shards
 
         return
 
 
+    @stage
+    def build_paths(self):
+        """Builds the path of each label in the delivery, according to
+        use_dir, with string operations over the whole index"""
+
+        filenames = self.index.filename.astype(str)
+
+        if not self.use_dir:
+            # simply use the bundle/collection root
+            names = filenames.str.replace(path_name, '', regex=True)
+            bundle = self.index.product_type == 'Product_Bundle'
+            self.index['path'] = self.index.bundle + os.sep + names.where(bundle, self.index.collection + os.sep + names)
+        else:
+            # use the path relative to the input directory
+            root = os.path.join(os.path.abspath(self.input_dir), '')
+            inside = filenames.str.startswith(root)
+            relative = filenames.str[len(root):].where(inside)
+            if not inside.all():
+                relative[~inside] = [os.path.relpath(label, start=self.input_dir) for label in filenames[~inside]]
+            self.index['path'] = self.index.bundle + os.sep + relative
+
+        self.stats.add(files=len(self.index))
+
+        return
+
 
+    @stage
     def create_transfer_manifest(self):
 
         # create tab separated files
@@ -195,44 +499,56 @@ class Packager():
             'path_start': lidvid_len + 1,
             'path_len': path_len}
 
-        # pandas to_string does weird things and pads strings, so using numpy instead
-        np.savetxt(self.manifest_file, self.index[['lidvid','path']].values, fmt='%-{:d}s%-{:d}s'.format(lidvid_len+1, path_len), newline='\r\n')
+        # fixed width records, padded as pandas to_string would not
+        records = self.index.lidvid.str.ljust(lidvid_len + 1) + self.index.path.str.ljust(path_len) + '\r\n'
+        with open(self.manifest_file, 'w', newline='', buffering=manifest_buffer_size) as f:
+            f.writelines(records)
 
         self.transfer_records =  len(self.index)
+        self.stats.add(files=1, bytes_written=os.path.getsize(self.manifest_file))
 
         return
 
 
-    def create_checksum_manifest(self, template=None):
+    def package_files(self):
+        """Returns a list of (source, path) tuples for each label and data
+        file in the package, where path is the location in the delivery"""
+
+        # one row for the label (data_file None) and one for each data file of every product
+        files = self.index[['filename', 'path']].assign(
+            data_file=self.index.lidvid.map(lambda lidvid: [None] + list(self.data_files[lidvid]))).explode('data_file')
+
+        label = files.data_file.isna()
+        sources = files.filename.where(label, files.filename.str.replace(path_dir, '', regex=True) + os.sep + files.data_file)
+        paths = files.path.where(label, files.path.str.replace(path_dir, '', regex=True) + os.sep + files.data_file)
 
-        checksum = pd.DataFrame([], columns=['checksum', 'filepath'])
-        check = []
-        filepath = []
+        return list(zip(sources.tolist(), paths.tolist()))
 
-        for idx, product in self.index.iterrows():
-            # add the label checksum
-            check.append(self.md5_hash(product.filename))
-            filepath.append(product.path)
 
-            # add the data file checksums
-            for data_file in self.data_files[product.lidvid]:
-                data_file_absolute = os.path.join(pathlib.Path(product.filename).parent, data_file)
-                check.append(self.md5_hash(data_file_absolute))
-                filepath.append(os.path.join(pathlib.Path(product.path).parent, data_file))
+    @stage
+    def create_checksum_manifest(self, template=None):
+
+        files = self.package_files()
 
-        checksum['checksum'] = check
-        checksum['filepath'] = filepath
+        checksums = self.hash_files([source for source, path in files])
 
         checksum_file = self.delivery_name + '-checksum_manifest.tab'
         self.checksum_file = os.path.join(self.package_dir, checksum_file)
-        checksum.to_csv(self.checksum_file, lineterminator='\r\n', sep='\t', header=False, index=False)
+        with open(self.checksum_file, 'w', newline='', buffering=manifest_buffer_size) as f:
+            f.writelines('{:s}\t{:s}\r\n'.format(checksum, path) for checksum, (source, path) in zip(checksums, files))
         
-        self.checksum_records = len(checksum)
+        self.checksum_records = len(files)
+        self.stats.add(files=1, bytes_written=os.path.getsize(self.checksum_file))
 
         return
 
 
+    @stage
     def create_label(self, template=None):
+        """Fills in the delivery label template (the bundled
+        product_delivery_template.xml if None) and writes it to the package
+        directory. The template is parsed once (see load_template) and the
+        fields set through the precompiled XPaths in aip_xpaths"""
 
         if template is None:
             # if no template is given, look for defaults
@@ -242,56 +558,57 @@ class Packager():
             template_file = template
         
         if not pathlib.Path(template_file).exists():
-            log.error('could not open template file {:s}'.format(template.name))
+            log.error('could not open template file {:s}'.format(pathlib.Path(template_file).name))
             return None
         else:
-            tree = etree.parse(template_file)
+            tree = copy.deepcopy(load_template(template_file))
             root = tree.getroot()
-            ns = root.nsmap
-            if None in ns and common.pds_ns == ns[None]:
-                ns['pds'] = ns.pop(None)
 
-        root.xpath('/pds:Product_AIP/pds:Identification_Area/pds:logical_identifier', namespaces=ns)[0].text = 'urn:esa:psa:{:s}:data_delivery:{:s}'.format(self.mission, self.delivery_name.lower())
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:Internal_Reference/pds:lid_reference', namespaces=ns)[0].text = 'urn:esa:psa:{:s}:{:s}'.format(self.mission, self.bundle)
+        creation_time = self.delivery_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        aip_xpaths['logical_identifier'](root)[0].text = 'urn:esa:psa:{:s}:data_delivery:{:s}'.format(self.mission, self.delivery_name.lower())
+        aip_xpaths['bundle_lid_reference'](root)[0].text = 'urn:esa:psa:{:s}:{:s}'.format(self.mission, self.bundle)
         
         cf = pathlib.Path(self.checksum_file)
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Checksum_Manifest/pds:File/pds:file_name', namespaces=ns)[0].text  = self.delivery_name + '-checksum_manifest.tab'
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Checksum_Manifest/pds:File/pds:creation_date_time', namespaces=ns)[0].text = self.delivery_time.strftime('%Y-%m-%dT%H:%M:%SZ')
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Checksum_Manifest/pds:File/pds:file_size', namespaces=ns)[0].text = str(cf.stat().st_size)
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Checksum_Manifest/pds:File/pds:records', namespaces=ns)[0].text = str(self.checksum_records)
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Checksum_Manifest/pds:File/pds:md5_checksum', namespaces=ns)[0].text = self.md5_hash(self.checksum_file)
+        aip_xpaths['checksum_file_name'](root)[0].text  = self.delivery_name + '-checksum_manifest.tab'
+        aip_xpaths['checksum_creation_date_time'](root)[0].text = creation_time
+        aip_xpaths['checksum_file_size'](root)[0].text = str(cf.stat().st_size)
+        aip_xpaths['checksum_file_records'](root)[0].text = str(self.checksum_records)
+        aip_xpaths['checksum_md5_checksum'](root)[0].text = self.md5_hash(self.checksum_file)
 
         tf = pathlib.Path(self.manifest_file)
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:File/pds:file_name', namespaces=ns)[0].text = self.delivery_name + '-transfer_manifest.tab'
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:File/pds:creation_date_time', namespaces=ns)[0].text = self.delivery_time.strftime('%Y-%m-%dT%H:%M:%SZ')
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:File/pds:file_size', namespaces=ns)[0].text =str(tf.stat().st_size)
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:File/pds:records', namespaces=ns)[0].text = str(self.transfer_records)
+        aip_xpaths['transfer_file_name'](root)[0].text = self.delivery_name + '-transfer_manifest.tab'
+        aip_xpaths['transfer_creation_date_time'](root)[0].text = creation_time
+        aip_xpaths['transfer_file_size'](root)[0].text =str(tf.stat().st_size)
+        aip_xpaths['transfer_file_records'](root)[0].text = str(self.transfer_records)
 
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:Record_Character/pds:Field_Character[1]/pds:field_length', namespaces=ns)[0].text = str(self.transfer_fields['lid_len'])
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:Record_Character/pds:Field_Character[2]/pds:field_location', namespaces=ns)[0].text = str(self.transfer_fields['path_start'])
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:Record_Character/pds:Field_Character[2]/pds:field_length', namespaces=ns)[0].text = str(self.transfer_fields['path_len'])
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:Record_Character[1]/pds:record_length', namespaces=ns)[0].text = str(self.transfer_fields['path_start'] + self.transfer_fields['path_len'] + 2)
+        aip_xpaths['lidvid_field_length'](root)[0].text = str(self.transfer_fields['lid_len'])
+        aip_xpaths['path_field_location'](root)[0].text = str(self.transfer_fields['path_start'])
+        aip_xpaths['path_field_length'](root)[0].text = str(self.transfer_fields['path_len'])
+        aip_xpaths['record_length'](root)[0].text = str(self.transfer_fields['path_start'] + self.transfer_fields['path_len'] + 2)
 
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:File/pds:md5_checksum', namespaces=ns)[0].text = self.md5_hash(self.manifest_file)
-        root.xpath('/pds:Product_AIP/pds:Information_Package_Component/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:records', namespaces=ns)[0].text = str(self.transfer_records)
-        root.xpath('/pds:Product_AIP/pds:Archival_Information_Package/pds:description', namespaces=ns)[0].text = 'Generated by bepicolombo.psa_utils.Packager'
+        aip_xpaths['transfer_md5_checksum'](root)[0].text = self.md5_hash(self.manifest_file)
+        aip_xpaths['transfer_manifest_records'](root)[0].text = str(self.transfer_records)
+        aip_xpaths['description'](root)[0].text = 'Generated by bepicolombo.psa_utils.Packager'
 
         # write out the modified label
         label_file = os.path.join(self.package_dir, self.delivery_name + '.xml')
         tree.write(label_file, xml_declaration=True, encoding=tree.docinfo.encoding) 
+        self.stats.add(files=1, bytes_written=os.path.getsize(label_file))
 
         return
 
+    @stage
     def create_package(self, clean):
 
         # create a directory
         product_dir = os.path.join(self.package_dir, self.bundle)
         os.makedirs(product_dir, exist_ok=True)
 
-        for idx, product in self.index.iterrows():
+        for source, path in self.package_files():
 
             # create the directory structure
-            path = os.path.join(self.package_dir, pathlib.Path(product.path).parent)
+            path = os.path.join(self.package_dir, pathlib.Path(path).parent)
 
             try:
                 os.makedirs(path, exist_ok=True)
@@ -299,17 +616,16 @@ class Packager():
                 log.error ("creation of the directory %s failed" % path)
                 return None
 
-            # copy the label
-            shutil.copy(product.filename, path)
-
-            # copy the data files referenced
-            for data_file in self.data_files[product.lidvid]:
-                data_file_absolute = os.path.join(pathlib.Path(product.filename).parent, data_file)
-                shutil.copy(data_file_absolute, path)
+            # copy the label or data file
+            shutil.copy(source, path)
+            size = os.path.getsize(source)
+            self.stats.add(files=1, bytes_read=size, bytes_written=size)
 
         tarball = os.path.join(self.output_dir, self.delivery_name + '.tar.gz')
-        with tarfile.open(tarball, "w:gz") as tar:
+        with compress.open_tarball(tarball, backend=self.compression, level=self.compression_level) as tar:
             tar.add(self.package_dir, arcname=os.path.basename(self.package_dir))
+        self.stats.add(bytes_read=sum(os.path.getsize(os.path.join(path, filename))
+            for path, dirs, files in os.walk(self.package_dir) for filename in files), bytes_written=os.path.getsize(tarball))
 
         if clean:
             shutil.rmtree(self.package_dir)
@@ -317,13 +633,489 @@ class Packager():
         return
 
 
+    @stage
+    def stream_package(self, template=None, clean=True):
+        """Builds the tarball directly from the source labels and data files,
+        without copying them to the package directory, hashing each file as
+        it is written. The checksum manifest and label are then created from
+        these checksums and added, so every file is read only once.
+
+        The tarball has the same members as that of create_package, in the
+        same order wherever the bundle directory name sorts before the
+        delivery name (as it does for the default naming)."""
+
+        package = os.path.basename(self.package_dir)
+        tarball = os.path.join(self.output_dir, self.delivery_name + '.tar.gz')
+
+        # de-duplicate, and order as tar.add recursing through the directories would
+        files = {os.path.join(package, path): source for source, path in self.package_files()}
+        dirs = {package}
+        for member in files:
+            parent = os.path.dirname(member)
+            while parent not in dirs:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+        members = sorted(list(files) + list(dirs), key=lambda member: pathlib.PurePath(member).parts)
+
+        with compress.open_tarball(tarball, backend=self.compression, level=self.compression_level) as tar:
+
+            tar.copybufsize = hash_block_size
+            tar.dereference = True # store files in full, as the staging copy of create_package would
+            for member in members:
+                if member in dirs:
+                    tar.addfile(tar.gettarinfo(self.package_dir, arcname=member))
+                    continue
+                source = files[member]
+                with open(source, 'rb') as f:
+                    reader = HashingReader(f)
+                    tar.addfile(tar.gettarinfo(source, arcname=member, fileobj=f), fileobj=reader)
+                self.checksums[os.path.abspath(source)] = reader.hexdigest()
+                self.stats.add(files=1, bytes_read=reader.size)
+                if self.fingerprints is not None:
+                    self.fingerprints.put_md5(source, reader.hexdigest())
+
+            self.create_checksum_manifest()
+            self.create_label(template=template)
+            for filename in sorted(os.listdir(self.package_dir)):
+                tar.add(os.path.join(self.package_dir, filename), arcname=os.path.join(package, filename))
+        self.stats.add(bytes_written=os.path.getsize(tarball))
+
+        if clean:
+            shutil.rmtree(self.package_dir)
+
+        return
+
+
+    @stage
+    def stream_chunks(self, chunk_size=stream_chunk, sendfrom=None, sendto=None, template=None, clean=True):
+        """Builds the tarball as stream_package does, but finding, indexing and
+        checking the products chunk_size at a time, and discarding each chunk
+        once its files are in the tarball. Manifest records are appended to
+        disk as they are produced (the transfer manifest is padded to its
+        final field widths at the end), so memory use depends on chunk_size
+        and not on the number of products, except for the set of LIDVIDs
+        kept to detect duplicates.
+
+        Members are added in the order products are found. If a fatal
+        problem is found, the partial tarball and package directory are
+        removed. Problems from all chunks are collected in self.report"""
+
+        filenames = self.iter_filenames()
+        lidvids = set()
+        dirs = set()
+        reports = []
+        fatal = False
+        bundle = None
+        transfer_records = None
+
+        checksum_records = 0
+        lidvid_len, path_len = 0, 0
+
+        while True:
+
+            # index and check the next chunk of products
+            self.labels = {}
+            self.data_files = {}
+            chunk = list(itertools.islice(filenames, chunk_size))
+            if len(chunk) == 0:
+                break
+            self.index = self.index_products(chunk)
+            if len(self.index) == 0:
+                continue
+            self.index['lidvid'] = self.index.lid + '::' + self.index.vid
+
+            ok = self.check_products()
+            reports.append(self.report)
+            if bundle is not None and self.index.bundle.iloc[0] != bundle:
+                log.error('cannot package products from more than one bundle - aborting!')
+                reports.append(pd.DataFrame([(None, 'multiple bundles', ', '.join([bundle, self.index.bundle.iloc[0]]), True)], columns=self.report.columns))
+                ok = False
+            duplicated = self.index[self.index.lidvid.isin(lidvids)]
+            if len(duplicated) > 0:
+                log.error('duplicated product LIDVIDs in this package - aborting!')
+                reports.append(pd.DataFrame([(filename, 'duplicated LIDVID', lidvid, True) for filename, lidvid in
+                    zip(duplicated.filename, duplicated.lidvid)], columns=self.report.columns))
+                ok = False
+            if not ok:
+                fatal = True
+                break
+            lidvids.update(self.index.lidvid)
+            if len(self.index) == 0:
+                continue
+
+            if bundle is None:
+                # the first chunk names the delivery and opens the tarball
+                bundle = self.index.bundle.iloc[0]
+                self.get_delivery_name(sendfrom, sendto)
+                delivery_bundle = self.bundle
+                self.package_dir = os.path.join(self.output_dir, self.delivery_name)
+                os.makedirs(self.package_dir, exist_ok=True)
+                package = os.path.basename(self.package_dir)
+                tarball = os.path.join(self.output_dir, self.delivery_name + '.tar.gz')
+                self.checksum_file = os.path.join(self.package_dir, self.delivery_name + '-checksum_manifest.tab')
+                self.manifest_file = os.path.join(self.package_dir, self.delivery_name + '-transfer_manifest.tab')
+                records_file = os.path.join(self.output_dir, self.delivery_name + '-transfer_records.tmp')
+                tar = compress.open_tarball(tarball, backend=self.compression, level=self.compression_level)
+                tar.copybufsize = hash_block_size
+                tar.dereference = True # store files in full, as the staging copy of create_package would
+                checksums = open(self.checksum_file, 'w', newline='', buffering=manifest_buffer_size)
+                transfer_records = open(records_file, 'w', newline='', buffering=manifest_buffer_size)
+
+            # append the transfer records, unpadded for now
+            self.build_paths()
+            transfer_records.writelines(self.index.lidvid + '\t' + self.index.path + '\n')
+            lidvid_len = max(lidvid_len, self.index.lidvid.str.len().max())
+            path_len = max(path_len, self.index.path.str.len().max())
+
+            # add the labels and data files, with any new directories, hashing them as they are written
+            for source, path in self.package_files():
+                member = os.path.join(package, path)
+                parents = []
+                parent = os.path.dirname(member)
+                while parent and parent not in dirs:
+                    parents.append(parent)
+                    parent = os.path.dirname(parent)
+                for parent in reversed(parents):
+                    tar.addfile(tar.gettarinfo(self.package_dir, arcname=parent))
+                    dirs.add(parent)
+                with open(source, 'rb') as f:
+                    reader = HashingReader(f)
+                    tar.addfile(tar.gettarinfo(source, arcname=member, fileobj=f), fileobj=reader)
+                checksums.write('{:s}\t{:s}\r\n'.format(reader.hexdigest(), path))
+                checksum_records += 1
+                self.stats.add(files=1, bytes_read=reader.size)
+                if self.fingerprints is not None:
+                    self.fingerprints.put_md5(source, reader.hexdigest())
+
+            # tarfile keeps every TarInfo (and inode) written, which is not needed here
+            tar.members = []
+            tar.inodes = {}
+            if self.fingerprints is not None:
+                self.fingerprints.commit()
+
+        self.index = None
+        self.labels = {}
+        self.data_files = {}
+        self.report = pd.concat(reports, ignore_index=True) if len(reports) > 0 else None
+
+        if bundle is None:
+            if not fatal:
+                log.error('no products found to package')
+            return None
+
+        checksums.close()
+        transfer_records.close()
+
+        if fatal:
+            log.error('removing incomplete delivery package {:s}'.format(self.delivery_name))
+            tar.close()
+            os.remove(tarball)
+            os.remove(records_file)
+            shutil.rmtree(self.package_dir)
+            return None
+
+        # pad the transfer records to the widest LIDVID and path
+        self.transfer_fields = {
+            'lid_start': 1,
+            'lid_len': lidvid_len,
+            'path_start': lidvid_len + 1,
+            'path_len': path_len}
+        self.transfer_records = 0
+        with open(records_file, 'r', newline='') as records, \
+                open(self.manifest_file, 'w', newline='', buffering=manifest_buffer_size) as f:
+            for record in records:
+                lidvid, path = record.rstrip('\n').split('\t')
+                f.write(lidvid.ljust(lidvid_len + 1) + path.ljust(path_len) + '\r\n')
+                self.transfer_records += 1
+        os.remove(records_file)
+        self.checksum_records = checksum_records
+        self.bundle = delivery_bundle
+
+        with tar:
+            self.create_label(template=template)
+            for filename in sorted(os.listdir(self.package_dir)):
+                tar.add(os.path.join(self.package_dir, filename), arcname=os.path.join(package, filename))
+        self.stats.add(bytes_written=os.path.getsize(tarball))
+
+        if clean:
+            shutil.rmtree(self.package_dir)
+
+        return
+
+
+    @stage
+    def hash_files(self, filenames):
+        """Computes the MD5 checksums of the given files on a pool of
+        self.workers threads (hashlib releases the GIL, so reading and hashing
+        proceed in parallel). Files already hashed, in this run or (if
+        self.fingerprints is set) an earlier one, are skipped. Returns the
+        list of checksums, in the order of filenames"""
+
+        absolute = list(map(os.path.abspath, filenames))
+        filenames = [f for f in dict.fromkeys(absolute) if f not in self.checksums]
+
+        if self.fingerprints is not None:
+            remaining = []
+            for filename in filenames:
+                checksum = self.fingerprints.get_md5(filename)
+                if checksum is None:
+                    remaining.append(filename)
+                else:
+                    self.checksums[filename] = checksum
+            filenames = remaining
+
+        if len(filenames) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+                for filename, checksum in zip(filenames, executor.map(md5_file, filenames)):
+                    self.checksums[filename] = checksum
+                    self.stats.add(files=1, bytes_read=os.path.getsize(filename))
+                    if self.fingerprints is not None:
+                        self.fingerprints.put_md5(filename, checksum)
+
+            if self.fingerprints is not None:
+                self.fingerprints.commit()
+
+        return [self.checksums[filename] for filename in absolute]
+
+
     def md5_hash(self, filename):
+        """Returns the MD5 checksum of filename, which is computed only once
+        for each file"""
+
+        filename = os.path.abspath(filename)
+        if filename not in self.checksums:
+            self.checksums[filename] = md5_file(filename)
+
+        return self.checksums[filename]
+
+
+pds_namespaces = {'pds': common.pds_ns}
+xpath_product_type = etree.XPath('name(/*)')
+xpath_lid = etree.XPath('pds:Identification_Area/pds:logical_identifier/text()', namespaces=pds_namespaces)
+xpath_vid = etree.XPath('pds:Identification_Area/pds:version_id/text()', namespaces=pds_namespaces)
+xpath_start_time = etree.XPath('//pds:Time_Coordinates/pds:start_date_time/text()', namespaces=pds_namespaces)
+xpath_stop_time = etree.XPath('//pds:Time_Coordinates/pds:stop_date_time/text()', namespaces=pds_namespaces)
+xpath_file_names = etree.XPath('//pds:file_name/text()', namespaces=pds_namespaces)
+
+# the fields of the delivery (AIP) label set by create_label
+aip_ipc = '/pds:Product_AIP/pds:Information_Package_Component'
+aip_xpaths = {name: etree.XPath(path, namespaces=pds_namespaces) for name, path in {
+    'logical_identifier': '/pds:Product_AIP/pds:Identification_Area/pds:logical_identifier',
+    'bundle_lid_reference': aip_ipc + '/pds:Internal_Reference/pds:lid_reference',
+    'checksum_file_name': aip_ipc + '/pds:File_Area_Checksum_Manifest/pds:File/pds:file_name',
+    'checksum_creation_date_time': aip_ipc + '/pds:File_Area_Checksum_Manifest/pds:File/pds:creation_date_time',
+    'checksum_file_size': aip_ipc + '/pds:File_Area_Checksum_Manifest/pds:File/pds:file_size',
+    'checksum_file_records': aip_ipc + '/pds:File_Area_Checksum_Manifest/pds:File/pds:records',
+    'checksum_md5_checksum': aip_ipc + '/pds:File_Area_Checksum_Manifest/pds:File/pds:md5_checksum',
+    'transfer_file_name': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:File/pds:file_name',
+    'transfer_creation_date_time': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:File/pds:creation_date_time',
+    'transfer_file_size': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:File/pds:file_size',
+    'transfer_file_records': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:File/pds:records',
+    'transfer_md5_checksum': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:File/pds:md5_checksum',
+    'lidvid_field_length': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:Record_Character/pds:Field_Character[1]/pds:field_length',
+    'path_field_location': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:Record_Character/pds:Field_Character[2]/pds:field_location',
+    'path_field_length': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:Record_Character/pds:Field_Character[2]/pds:field_length',
+    'record_length': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:Record_Character[1]/pds:record_length',
+    'transfer_manifest_records': aip_ipc + '/pds:File_Area_Transfer_Manifest/pds:Transfer_Manifest/pds:records',
+    'description': '/pds:Product_AIP/pds:Archival_Information_Package/pds:description'}.items()}
+
+# parsed label templates, keyed by file name
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def load_template(template_file):
+    """Returns the parsed label template template_file, which is read from
+    disk only the first time (or once it has changed). The tree is shared,
+    so callers should fill in a copy.deepcopy of it"""
+
+    mtime = os.stat(template_file).st_mtime_ns
+
+    with _templates_lock:
+        if template_file not in _templates or _templates[template_file][0] != mtime:
+            _templates[template_file] = (mtime, etree.parse(template_file))
+        return _templates[template_file][1]
+
+
+def parse_label(filename):
+    """Parses a PDS4 label, returning a dictionary of its product_type and,
+    for product labels, its lid, vid, start_time and stop_time (as in
+    dbase.index_products) and the file_name of each file it references
+    (data_files). If the label cannot be read, the dictionary instead
+    gives the error"""
+
+    try:
+        root = etree.parse(filename).getroot()
+    except (OSError, etree.XMLSyntaxError) as err:
+        return {'product_type': '', 'error': str(err)}
+
+    product_type = xpath_product_type(root)
+    if not product_type.startswith('Product_'):
+        return {'product_type': product_type}
+
+    lid = xpath_lid(root)
+    vid = xpath_vid(root)
+    if len(lid) == 0 or len(vid) == 0:
+        return {'product_type': product_type, 'error': 'no logical_identifier or version_id'}
+
+    start_time = xpath_start_time(root)
+    stop_time = xpath_stop_time(root)
+
+    return {
+        'product_type': product_type,
+        'lid': str(lid[0]),
+        'vid': str(vid[0]),
+        'start_time': str(start_time[0]) if len(start_time)>0 else None,
+        'stop_time': str(stop_time[0]) if len(stop_time)>0 else None,
+        'data_files': [str(f) for f in xpath_file_names(root)]}
+
+
+class HashingReader():
+    """Wraps a binary file object, computing the MD5 checksum of the data
+    as it is read"""
+
+    def __init__(self, f):
+
+        self.f = f
+        self.hasher = hashlib.md5()
+        self.size = 0
+
+    def read(self, size=-1):
+
+        data = self.f.read(size)
+        self.hasher.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+
+        return self.hasher.hexdigest()
+
+
+def md5_file(filename, block_size=hash_block_size):
+    """Returns the MD5 checksum of filename, read block_size bytes at a time"""
+
+    hasher = hashlib.md5()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            hasher.update(view[:size])
+
+    return hasher.hexdigest()
+
+
+class StageStats():
+    """Records the wall time, bytes read and written and files processed
+    by each stage of a Packager run. Stages may be nested (time spent in an
+    inner stage also counts towards the outer one) and may run in several
+    threads, as when shards are built in parallel"""
+
+    def __init__(self):
+
+        self.records = []
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+
+    @contextlib.contextmanager
+    def stage(self, name, delivery=None):
+        """A context manager recording a stage called name. Counters added
+        in this thread while it runs (see add) are recorded against it"""
+
+        record = {
+            'stage': name,
+            'delivery': delivery,
+            'thread': threading.get_ident(),
+            'start': time.perf_counter() - self.start,
+            'time': 0.,
+            'files': 0,
+            'bytes_read': 0,
+            'bytes_written': 0}
+
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        self._local.stack.append(record)
+
+        try:
+            yield record
+        finally:
+            self._local.stack.pop()
+            record['time'] = time.perf_counter() - self.start - record['start']
+            with self._lock:
+                self.records.append(record)
+
+
+    def add(self, files=0, bytes_read=0, bytes_written=0):
+        """Adds to the counters of the innermost stage running in this thread"""
+
+        stack = getattr(self._local, 'stack', None)
+        if not stack:
+            return
+
+        record = stack[-1]
+        record['files'] += files
+        record['bytes_read'] += bytes_read
+        record['bytes_written'] += bytes_written
 
-        BLOCKSIZE = 65536
-        hasher = hashlib.md5()
-        with open(filename, 'rb') as f:
-            buf = f.read(BLOCKSIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = f.read(BLOCKSIZE)
-        return hasher.hexdigest()
+        return
+
+
+    def to_dataframe(self):
+        """Returns a DataFrame with one row for each stage run, in the order
+        they finished, with the read and write rates in MB/s"""
+
+        with self._lock:
+            stats = pd.DataFrame(self.records, columns=[
+                'stage', 'delivery', 'thread', 'start', 'time', 'files', 'bytes_read', 'bytes_written'])
+
+        elapsed = stats.time.where(stats.time > 0)
+        stats['read_rate'] = (stats.bytes_read / 1e6 / elapsed).fillna(0.)
+        stats['write_rate'] = (stats.bytes_written / 1e6 / elapsed).fillna(0.)
+
+        return stats
+
+
+    def summary(self):
+        """Returns a DataFrame of the totals for each stage, in the order the
+        stages were first started, with the read and write rates in MB/s"""
+
+        stats = self.to_dataframe().sort_values('start')
+        summary = stats.groupby('stage', sort=False).agg(
+            calls=('stage', 'size'), time=('time', 'sum'), files=('files', 'sum'),
+            bytes_read=('bytes_read', 'sum'), bytes_written=('bytes_written', 'sum'))
+
+        elapsed = summary.time.where(summary.time > 0)
+        summary['read_rate'] = (summary.bytes_read / 1e6 / elapsed).fillna(0.)
+        summary['write_rate'] = (summary.bytes_written / 1e6 / elapsed).fillna(0.)
+
+        return summary
+
+
+    def write_trace(self, filename):
+        """Writes the stages run to filename as a JSON trace, in the Trace
+        Event Format read by chrome://tracing and Perfetto"""
+
+        with self._lock:
+            events = [{
+                'name': record['stage'],
+                'ph': 'X',
+                'ts': round(record['start'] * 1e6),
+                'dur': round(record['time'] * 1e6),
+                'pid': os.getpid(),
+                'tid': record['thread'],
+                'args': {key: record[key] for key in ['delivery', 'files', 'bytes_read', 'bytes_written']}}
+                for record in self.records]
+
+        try:
+            with open(filename, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, indent=1)
+        except OSError as err:
+            log.error('could not write trace file {:s}: {:s}'.format(filename, str(err)))
+            return None
+
+        return
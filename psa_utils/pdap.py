@@ -10,17 +10,35 @@ A module to make PDAP queries of the PSA
 from astropy.io import votable
 
 psa_pdap_url = 'https://archives.esac.esa.int/psa/pdap'
+votable_chunk_size = 10000 # rows per DataFrame when streaming a VOTable
+version_workers = 4 # bundles queried concurrently by latest_versions
+version_ttl = 3600 # seconds a resolved VID is memoised by latest_versions
+import time
 import logging
 import functools
+import threading
+import urllib3
 import requests
 import warnings
+import numpy as np
 import pandas as pd
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
+from . import transport
 
 
 log = logging.getLogger(__name__)
+
+# errors which can interrupt a streamed VOTable: requests does not wrap those
+# raised by urllib3 while reading the raw response, and truncated XML fails to parse
+stream_errors = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, etree.XMLSyntaxError)
 warnings.simplefilter('ignore', category=votable.exceptions.VOTableSpecWarning)
 
+# VIDs resolved by latest_versions, keyed by LID
+_versions = {}
+_versions_lock = threading.Lock()
+
 def exception(function):
     """
     A decorator that wraps the passed in function and handles
@@ -39,9 +57,12 @@ def exception(function):
 
 class Pdap:
 
-    def __init__(self, pdap_url=psa_pdap_url):
+    def __init__(self, pdap_url=psa_pdap_url, session=None):
+        """Accepts the PDAP base URL and optionally a requests Session - if
+        None the shared session from transport.get_session is used"""
 
         self.url = pdap_url
+        self.session = transport.get_session() if session is None else session
 
     def _url(self, path):
         """Helper function to append the path to the base URL"""
@@ -52,7 +73,7 @@ class Pdap:
     def get_datasets(self):
         """Retrieves meta-data for the set of datasets/bundles"""
 
-        r = requests.get(
+        r = self.session.get(
             self._url('/metadata'),
             params={
                 'RETURN_TYPE': 'VOTABLE',
@@ -69,7 +90,7 @@ class Pdap:
         """Queries the meta-data endpoint for products in the dataset ID
         given in the call"""
 
-        r = requests.get(
+        r = self.session.get(
             self._url('/metadata'),
             params={
                 'RETURN_TYPE': 'VOTABLE',
@@ -87,7 +108,7 @@ class Pdap:
     @exception
     def get_product(self, product_id):
 
-        r = requests.get(
+        r = self.session.get(
             self._url('/metadata'),
             params={
                 'RETURN_TYPE': 'VOTABLE',
@@ -105,7 +126,7 @@ class Pdap:
     @exception
     def get_files(self, dataset_id):
 
-        r = requests.get(
+        r = self.session.get(
             self._url('/files'),
             params={
                 'RETURN_TYPE': 'VOTABLE',
@@ -117,9 +138,155 @@ class Pdap:
 
         return data
 
+    @exception
+    def _stream(self, path, params):
+        """Makes a streamed request of the given endpoint, returning the
+        response before the body has been read"""
+
+        r = self.session.get(self._url(path), params=params, stream=True)
+        r.raise_for_status()
+        r.raw.decode_content = True
+
+        return r
+
+    def _iter_votable(self, path, params, columns, where, chunk_size):
+        """Streams the VOTable returned by the endpoint through iter_votable.
+        If the request fails nothing is yielded, but if the stream is broken
+        off part way the error is logged and raised again (one of
+        stream_errors), so that a truncated table is never taken as complete"""
+
+        r = self._stream(path, params)
+        if r is None:
+            return
+
+        with r:
+            try:
+                yield from iter_votable(r.raw, columns=columns, where=where, chunk_size=chunk_size)
+            except stream_errors as e:
+                log.error('error reading VOTable from {:s}: {:s}'.format(self._url(path), str(e)))
+                raise
+
+    def iter_products(self, dataset_id, columns=None, where=None, chunk_size=votable_chunk_size):
+        """As get_products, but parses the response as it is received and
+        yields DataFrames of at most chunk_size rows. See iter_votable for
+        the columns and where arguments, and _iter_votable for errors"""
+
+        params = {
+            'RETURN_TYPE': 'VOTABLE',
+            'RESOURCE_CLASS': 'PRODUCT',
+            'DATA_SET_ID': dataset_id}
+
+        for data in self._iter_votable('/metadata', params, columns, where, chunk_size):
+            if 'PRODUCT.DATA_ACCESS_REFERENCE' in data.columns:
+                data['VID'] = data['PRODUCT.DATA_ACCESS_REFERENCE'].str.split('::').str[-1]
+            yield data
+
+    def iter_files(self, dataset_id, columns=None, where=None, chunk_size=votable_chunk_size):
+        """As get_files, but parses the response as it is received and yields
+        DataFrames of at most chunk_size rows, so that the file list of a large
+        dataset is never held in memory in full. See iter_votable for the
+        columns and where arguments, and _iter_votable for errors"""
+
+        params = {
+            'RETURN_TYPE': 'VOTABLE',
+            'RESOURCE_CLASS': 'PRODUCT',
+            'DATA_SET_ID': dataset_id}
+
+        yield from self._iter_votable('/files', params, columns, where, chunk_size)
+
+
+def iter_votable(source, columns=None, where=None, chunk_size=votable_chunk_size):
+    """Parses a single-table VOTable incrementally from the file-like (or
+    file name) source, yielding DataFrames of at most chunk_size rows.
+    Rows are discarded from the XML tree once read, so memory use depends on
+    chunk_size rather than on the size of the table.
+
+    Columns are named as by astropy (the FIELD ID if given, otherwise its
+    name) and converted according to their datatype, with empty cells filled
+    in the same way as the masked astropy table used by get_files.
+
+    columns - if given, the list of columns to keep
+    where - if given, a function accepting a DataFrame chunk and returning a
+        boolean mask of the rows to keep (chunks left empty are not yielded)
+
+    Only the TABLEDATA serialisation is supported."""
+
+    fields = []
+    keep = None
+    rows = []
+
+    def chunk():
+        data = pd.DataFrame(rows, columns=[fields[i][0] for i in keep], dtype=object)
+        for name, datatype in (fields[i] for i in keep):
+            data[name] = convert(data[name], datatype)
+        if where is not None:
+            data = data[where(data)].reset_index(drop=True)
+        return data
+
+    for event, elem in etree.iterparse(source, events=('end',), tag=('{*}FIELD', '{*}TR', '{*}BINARY', '{*}BINARY2', '{*}FITS')):
+
+        tag = etree.QName(elem).localname
+
+        if tag == 'FIELD':
+            fields.append((elem.get('ID', elem.get('name')), elem.get('datatype', 'char')))
+            continue
+
+        if tag != 'TR':
+            log.error('only VOTables with TABLEDATA serialisation can be streamed')
+            return
+
+        if keep is None:
+            names = [name for name, _ in fields]
+            if columns is None:
+                keep = list(range(len(fields)))
+            else:
+                missing = set(columns) - set(names)
+                if missing:
+                    log.error('columns {:s} not found in VOTable'.format(', '.join(sorted(missing))))
+                    return
+                keep = [names.index(name) for name in columns]
+
+        cells = [td.text for td in elem]
+        rows.append([cells[i] if i < len(cells) else None for i in keep])
+
+        # free the row, and any already processed siblings
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+        if len(rows) >= chunk_size:
+            data = chunk()
+            rows = []
+            if len(data):
+                yield data
+
+    if rows:
+        data = chunk()
+        if len(data):
+            yield data
+
+    return
+
+
+def convert(values, datatype):
+    """Converts a Series of VOTable cell strings (None for empty cells) to
+    the type given by the VOTable datatype"""
+
+    if datatype in ['char', 'unicodeChar']:
+        return values.fillna('').astype(str)
+    elif datatype == 'boolean':
+        return values.fillna('').str.strip().str.upper().isin(['T', 'TRUE', '1'])
+    elif datatype in ['unsignedByte', 'short', 'int', 'long']:
+        return pd.to_numeric(values, errors='coerce').fillna(0).astype(np.int64)
+    elif datatype in ['float', 'double']:
+        return pd.to_numeric(values, errors='coerce').astype(np.float64)
+    else:
+        return values
+
 
 def latest_version(lid):
-    """Uses PDAP to retrieve the highest VID for a given LID"""
+    """Uses PDAP to retrieve the highest VID for a given LID (see
+    latest_versions to resolve many LIDs)"""
 
     psa_pdap = Pdap()
     product = psa_pdap.get_product(lid)
@@ -130,3 +297,79 @@ def latest_version(lid):
         version_list = product.VID.tolist()
         version_list.sort(key=lambda s: list(map(int, s.split('.'))))
         return version_list[-1]
+
+
+def latest_versions(lids, workers=version_workers, ttl=version_ttl):
+    """Uses PDAP to retrieve the highest VID of each of a list of LIDs
+    (or PDS3 product IDs), returning a dictionary of LID: VID, with None
+    for products which are not found.
+
+    Rather than one request per LID, the LIDs are grouped by bundle (or
+    data set) and the product list of each bundle is streamed once, up to
+    workers bundles at a time. Results are memoised for ttl seconds (None
+    to always query PDAP)."""
+
+    versions = {}
+    now = time.time()
+    with _versions_lock:
+        for lid in set(lids):
+            if ttl is not None and lid in _versions and now - _versions[lid][0] <= ttl:
+                versions[lid] = _versions[lid][1]
+
+    remaining = pd.Series(sorted(set(lids) - set(versions)), dtype=object)
+    if len(remaining) == 0:
+        return versions
+
+    parts = remaining.str.split(':')
+    bundles = parts.str[0:4].str.join(':').where(remaining.str.startswith('urn:'), parts.str[0])
+
+    psa_pdap = Pdap()
+    columns = ['PRODUCT.PRODUCT_ID', 'PRODUCT.DATA_ACCESS_REFERENCE']
+
+    def resolve(bundle):
+        wanted = pd.Index(remaining[bundles == bundle]) # hashed once, then probed per chunk
+        try:
+            chunks = list(psa_pdap.iter_products(
+                bundle, columns=columns, where=lambda chunk: wanted.get_indexer(chunk['PRODUCT.PRODUCT_ID']) >= 0))
+        except stream_errors:
+            return {} # already logged; the LIDs of this bundle are returned as None and not memoised
+        if len(chunks) == 0:
+            return {}
+        products = pd.concat(chunks, ignore_index=True)
+        products = products[latest_mask(products['PRODUCT.PRODUCT_ID'], products.VID)]
+        return dict(zip(products['PRODUCT.PRODUCT_ID'], products.VID))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, bundles.nunique()))) as executor:
+        for found in executor.map(resolve, bundles.unique()):
+            versions.update(found)
+
+    with _versions_lock:
+        for lid in remaining:
+            if lid in versions:
+                _versions[lid] = (now, versions[lid])
+            else:
+                log.error('product with LID {:s} not found'.format(lid))
+                versions[lid] = None
+
+    return versions
+
+
+def latest_mask(lids, vids):
+    """Accepts Series of LIDs and of VIDs (in the form major.minor) and
+    returns a boolean mask selecting the row with the highest VID of each
+    LID. VIDs are compared numerically, so that 1.10 is later than 1.9"""
+
+    vid = vids.str.split('.', expand=True).reindex(columns=[0, 1]).fillna('0').astype(np.int64)
+    order = pd.DataFrame({'lid': lids, 'major': vid[0], 'minor': vid[1]}).sort_values(['lid', 'major', 'minor'])
+    latest = order.index[~order.lid.duplicated(keep='last')]
+
+    return lids.index.isin(latest)
+
+
+def clear_versions():
+    """Discards the VIDs memoised by latest_versions"""
+
+    with _versions_lock:
+        _versions.clear()
+
+    return
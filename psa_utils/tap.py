@@ -13,13 +13,27 @@ from astropy.io.votable import parse_single_table
 import pyvo as vo
 import pandas as pd
 from . import common
+from . import transport
 import time
+import re
 import numpy as np
 from requests.exceptions import HTTPError
-
-job_wait_time = 2 # seconds
-job_wait_cycles = 10
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import pyarrow as pa
+except ModuleNotFoundError:
+    pa = None
+
+job_poll_interval = 0.5 # initial interval between job status checks (seconds)
+job_poll_factor = 1.5 # increase in the poll interval each time a job is still running
+job_poll_max = 30 # longest interval between job status checks (seconds)
+job_timeout = 3600 # seconds before an asynchronous job is aborted
+async_jobs = 4 # maximum number of asynchronous jobs running at once
 psa_tap_url = 'https://archives.esac.esa.int/psa-tap/tap/'
+sync_limit = 2000 # maximum number of rows returned by a synchronous query
+page_time_margin = 1e-8 # days (~1 ms) by which a time page_key is moved back, as julian days do not convert exactly
+query_cache = None # a cache.ResultCache used by PsaTap instances created without cache=
 import logging
 log = logging.getLogger(__name__)
 logging.getLogger("astroquery").setLevel(logging.WARNING)
@@ -27,66 +41,409 @@ logging.getLogger("astroquery").setLevel(logging.WARNING)
 
 class PsaTap:
 
-    def __init__(self, tap_url=psa_tap_url, proxy=None):
-        """Establish a connection to the PSA TAP server"""
+    def __init__(self, tap_url=psa_tap_url, proxy=None, session=None, cache=None):
+        """Establish a connection to the PSA TAP server. If session is None the
+        session shared for the given proxy (host:port of a SOCKS5 proxy) from
+        transport.get_session is used.
+
+        cache can be a cache.ResultCache in which synchronous query results are
+        kept, keyed on the normalised ADQL and the service URL. If None the
+        module-level query_cache is used (by default no caching)."""
         # self.tap = Tap(url=tap_url)
-        self.proxy = None if proxy is None else dict(http='socks5h://{:s}'.format(proxy),https='socks5h://{:s}'.format(proxy))
-        self.tap = vo.dal.TAPService(tap_url)
+        self.session = transport.get_session(proxy) if session is None else session
+        self.tap = vo.dal.TAPService(tap_url, session=self.session)
+        self.cache = query_cache if cache is None else cache
+
+
 
+    def query(self, q, sync=True, dropna=True, verbose=False, job_wait_cycles=None, job_wait_time=None, job_timeout=job_timeout,
+            use_cache=True, paginate=False, page_key='granule_uid', page_size=sync_limit):
+        """Make a simple query and return the data as a pandas DataFrame. Set
+        use_cache=False to bypass the result cache (if any).
 
+        If paginate=True a synchronous query is run as a series of queries of
+        up to page_size rows (at most sync_limit), each continuing from the
+        last value of page_key, and the results concatenated. This lifts the
+        synchronous row limit for queries of the form
+        SELECT [DISTINCT] columns FROM table [WHERE condition]
+        page_key need not be unique, but no more than page_size rows may
+        share a value (if they do, an error is logged and None returned)
 
-    def query(self, q, sync=True, dropna=True, verbose=False, job_wait_cycles=job_wait_cycles, job_wait_time=job_wait_time):
-        """Make a simple query and return the data as a pandas DataFrame"""
+        If sync=False the query is run as an asynchronous job (see query_async)
+        which is aborted after job_timeout seconds. For compatibility, the
+        timeout can also be given as job_wait_cycles * job_wait_time."""
         
-        if sync:
-            try:
-                data = self.tap.run_sync(q, maxrec=-1, proxies=self.proxy).to_table()
-            except ValueError as err:
-                log.error('query error: {0}'.format(err))
+        if not sync:
+            if job_wait_cycles is not None and job_wait_time is not None:
+                job_timeout = job_wait_cycles * job_wait_time
+            for idx, data in self.query_async([q], dropna=dropna, timeout=job_timeout):
+                return data
+
+        if paginate:
+            data = self._run_paged(q, page_key, page_size, use_cache)
+        else:
+            data = self._run_sync(q, use_cache)
+
+        data = self._finalise(data, dropna)
+
+        if data is not None and not paginate and len(data) == sync_limit:
+            log.warn('results incomplete due to synchronous query limit - repeat with paginate=True or sync=False')
+
+        return data# .squeeze()
+
+
+    def query_async(self, queries, dropna=True, max_jobs=async_jobs, timeout=job_timeout):
+        """Runs each of the queries given as an asynchronous (UWS) job, with up
+        to max_jobs running at once. Jobs are polled with an interval that
+        starts at job_poll_interval and grows to job_poll_max while they run,
+        and are aborted after timeout seconds. Results are fetched in the
+        background as each job completes.
+
+        This is a generator, yielding (index, data) for each query as its
+        results become available, where index is the position of the query in
+        queries and data is a DataFrame (or None if the job failed)."""
+
+        if isinstance(queries, str):
+            queries = [queries]
+
+        pending = list(enumerate(queries))
+        running = {} # index: [job, start, next poll, poll interval]
+        fetching = {} # future: index
+
+        with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+
+            while pending or running or fetching:
+
+                # keep up to max_jobs jobs running on the server
+                while pending and len(running) < max_jobs:
+                    idx, q = pending.pop(0)
+                    try:
+                        job = self.tap.submit_job(q, maxrec=-1).run()
+                    except (vo.dal.DALAccessError, HTTPError) as err:
+                        log.error('could not submit asynchronous query: {0}'.format(err))
+                        yield idx, None
+                        continue
+                    now = time.monotonic()
+                    running[idx] = [job, now, now + job_poll_interval, job_poll_interval]
+                    log.debug('submitted asynchronous job {:s}'.format(job.job_id))
+
+                # poll the jobs which are due, backing off while they are still running
+                now = time.monotonic()
+                for idx, (job, start, due, interval) in list(running.items()):
+                    if now < due:
+                        continue
+                    try:
+                        phase = job.phase
+                    except (vo.dal.DALAccessError, HTTPError) as err:
+                        log.warning('could not poll job {:s}: {:s}'.format(job.job_id, str(err)))
+                        phase = None
+                    if phase == 'COMPLETED':
+                        del running[idx]
+                        fetching[executor.submit(self._fetch_job, job)] = idx
+                    elif phase in ['ERROR', 'ABORTED']:
+                        del running[idx]
+                        log.error('asynchronous job {:s} failed'.format(job.job_id))
+                        self._delete_job(job)
+                        yield idx, None
+                    elif timeout is not None and now - start > timeout:
+                        del running[idx]
+                        log.error('asynchronous job {:s} did not complete in {:g} s, aborting'.format(job.job_id, timeout))
+                        self._delete_job(job)
+                        yield idx, None
+                    else:
+                        interval = min(interval * job_poll_factor, job_poll_max)
+                        running[idx] = [job, start, now + interval, interval]
+
+                # hand back results as they arrive
+                for future in [future for future in fetching if future.done()]:
+                    idx = fetching.pop(future)
+                    try:
+                        data = future.result()
+                    except (vo.dal.DALAccessError, HTTPError, ValueError) as err:
+                        log.error('could not retrieve asynchronous results: {0}'.format(err))
+                        data = None
+                    yield idx, self._finalise(data, dropna)
+
+                # sleep until the next job is due a poll, or a fetch completes
+                if running:
+                    delay = max(0., min(entry[2] for entry in running.values()) - time.monotonic())
+                else:
+                    delay = None
+                if fetching:
+                    wait(fetching, timeout=delay, return_when=FIRST_COMPLETED)
+                elif delay:
+                    time.sleep(delay)
+
+
+    def _fetch_job(self, job):
+        """Retrieves the results of a completed asynchronous job and deletes it"""
+
+        data = table_to_pandas(job.fetch_result().to_table())
+        self._delete_job(job)
+
+        return data
+
+
+    @staticmethod
+    def _delete_job(job):
+
+        try:
+            job.delete()
+        except (vo.dal.DALAccessError, HTTPError) as err:
+            log.debug('could not delete job: {0}'.format(err))
+
+
+    @staticmethod
+    def _finalise(data, dropna=True):
+        """Drops empty columns from a query result, returning None if the
+        query failed or returned no results"""
+
+        if data is None:
+            return None
+
+        if data.empty:
+            log.warn('no results returned')
+            return None
+
+        if dropna:
+            data.dropna(inplace=True, axis=1, how='all')
+
+        return data
+
+
+    def _run_sync(self, q, use_cache=True):
+        """Runs a synchronous query (or retrieves it from the cache) and returns
+        the data converted by table_to_pandas, or None on error"""
+
+        key = None
+        if self.cache and use_cache:
+            key = self.cache.key(self.tap.baseurl, normalise_adql(q))
+            data = self.cache.get(key)
+            if data is not None:
+                log.debug('query result retrieved from cache')
+                return data
+
+        try:
+            data = self.tap.run_sync(q, maxrec=-1).to_table()
+        except ValueError as err:
+            log.error('query error: {0}'.format(err))
+            return None
+        except HTTPError as err:
+            log.error('http error: {0}'.format(err))
+            return None
+
+        data = table_to_pandas(data)
+
+        if key is not None and not data.empty:
+            self.cache.put(key, data)
+
+        return data
+
+
+    def _run_paged(self, q, key, page_size=sync_limit, use_cache=True):
+        """Runs q as a series of synchronous queries of page_size rows, ordered
+        on the column key, and returns the concatenated results.
+
+        Each page starts from the last key value of the one before, whose rows
+        are dropped from that page, so that rows sharing a key value across a
+        page boundary are neither lost nor repeated"""
+
+        if page_size > sync_limit:
+            log.warning('page_size cannot exceed the synchronous query limit, using {:d}'.format(sync_limit))
+            page_size = sync_limit
+
+        paged = paged_query(q, key, page_size=page_size)
+        if paged is None:
+            return None
+        _, added_key = paged
+
+        pages = []
+        last = None
+        while True:
+            page_q, _ = paged_query(q, key, after=last, page_size=page_size)
+            page = self._run_sync(page_q, use_cache)
+            if page is None:
                 return None
-            except HTTPError as err:
-                log.error('http error: {0}'.format(err))
+            full = len(page) == page_size
+            log.debug('retrieved page {:d} with {:d} rows'.format(len(pages) + 1, len(page)))
+            if isinstance(last, pd.Timestamp):
+                # a time key is queried from slightly earlier (see paged_query); other keys
+                # are left in the server's order, which for strings may differ from python's
+                page = page[page[key] >= last]
+            if not full:
+                pages.append(page)
+                break
+            last = page[key].iloc[-1]
+            boundary = page[key] == last
+            if boundary.all():
+                log.error('more than {:d} rows have {:s} = {:s}, cannot paginate on this key'.format(
+                    page_size, key, str(last)))
                 return None
+            # the rows with the last key value are retrieved again in full with the next page
+            pages.append(page[~boundary])
 
-            data = data.to_pandas()
+        data = pd.concat(pages, ignore_index=True)
+        if added_key:
+            data.drop(columns=key, inplace=True)
 
-            if data.empty:
-                log.warn('no results returned')
-                return None
-            
-            # check for byte encoded (object) strings and decode to utf-8
-            for col, dtype in data.dtypes.items():
-                if dtype == np.object_:
-                    # check if we really have bytes here or a string
-                    if not isinstance(data[col].iloc[0], str):
-                        data[col] = data[col].str.decode('utf-8')
+        return data
+
+
+def paged_query(q, key, after=None, page_size=sync_limit):
+    """Rewrites a query of the form SELECT [DISTINCT] columns FROM table
+    [WHERE condition] to return the first page_size rows, ordered on column
+    key, with a key value greater than or equal to after (or from the start
+    if None). A Timestamp after is moved back by page_time_margin.
+
+    Returns the new query and a flag indicating whether key had to be added
+    to the selected columns, or None if the query cannot be paginated
+    (including aggregate queries, and DISTINCT queries not selecting key)."""
+
+    q = normalise_adql(q)
+
+    # look for unsupported clauses outside of quoted literals
+    unquoted = re.sub(r"'(?:[^']|'')*'", "''", q)
+    if re.search(r'\b(top|order\s+by|group\s+by|having|union|offset|join)\b', unquoted, re.IGNORECASE) or \
+            re.search(r'\b(count|sum|avg|min|max)\s*\(', unquoted, re.IGNORECASE) or \
+            len(re.findall(r'\bselect\b', unquoted, re.IGNORECASE)) > 1:
+        log.error('only queries of the form SELECT [DISTINCT] columns FROM table [WHERE condition] can be paginated')
+        return None
 
+    match = re.match(r'select\s+(distinct\s+)?(.+?)\s+from\s+(\S+)(?:\s+where\s+(.+))?$', q, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        log.error('could not parse query for pagination')
+        return None
+    distinct, columns, table, condition = match.groups()
+
+    # the key has to be returned to continue from the last row of a page
+    selected = [col.strip().split()[-1].lower() for col in columns.split(',')]
+    added_key = columns.strip() != '*' and key.lower() not in selected
+    if added_key and distinct:
+        # DISTINCT would then apply to the key as well, and remove no duplicates
+        log.error('a SELECT DISTINCT query can only be paginated on one of its selected columns')
+        return None
+    if added_key:
+        columns = '{:s}, {:s}'.format(columns, key)
+
+    conditions = [] if condition is None else ['({:s})'.format(condition)]
+    if after is not None:
+        if isinstance(after, pd.Timestamp):
+            # times are held as julian days by the service
+            after = after.to_julian_date() - page_time_margin
+        if isinstance(after, str):
+            after = "'{:s}'".format(after.replace("'", "''"))
         else:
-            log.error('async jobs currently disabled')
-            return None
-            job = self.tap.run_async(q, maxrec=-1)
-            for i in range(job_wait_cycles):
-                time.sleep(job_wait_time)
-                if job.is_finished():
-                    break
-            if not job.is_finished():
-                log.error('asynchronous query did not complete')
-                return None
-            data = job.get_results().to_pandas()
+            after = repr(after.item() if hasattr(after, 'item') else after)
+        conditions.append('{:s} >= {:s}'.format(key, after))
+
+    paged = 'SELECT {:s}TOP {:d} {:s} FROM {:s}'.format('DISTINCT ' if distinct else '', page_size, columns, table)
+    if conditions:
+        paged += ' WHERE ' + ' AND '.join(conditions)
+    paged += ' ORDER BY {:s}'.format(key)
+
+    return paged, added_key
+
+
+def _string_dtype():
+    """Returns the Arrow-backed pandas string dtype (with NaN for missing
+    values, as for object columns) if pandas and pyarrow support it, or
+    object otherwise"""
+
+    if pa is None:
+        return np.object_
+    try:
+        return pd.StringDtype('pyarrow', na_value=np.nan)
+    except TypeError:
+        return np.object_
+
+string_dtype = _string_dtype()
+julian_epoch = 2440587.5 # julian day of 1970-01-01T00:00:00
+ns_per_day = 86400 * 10**9
+
+
+def table_to_pandas(table):
+    """Converts an astropy Table returned by a query into a DataFrame in a
+    single pass over its columns, working on the underlying numpy arrays:
+    byte strings are decoded, strings are held with string_dtype, time_min
+    and time_max are converted from julian days and masked values become
+    NaN (or NA for integer and boolean columns, as Table.to_pandas)"""
+
+    columns = {}
+    for name in table.colnames:
+
+        col = table[name]
+        values = np.ma.getdata(col)
+        mask = np.ma.getmaskarray(col)
+        masked = mask.any()
+
+        if values.ndim > 1:
+            # array-valued cells are kept as an object column of arrays
+            columns[name] = pd.Series(list(values), dtype=np.object_)
+            continue
+
+        kind = values.dtype.kind
+
+        if kind in 'SU' and string_dtype is not np.object_:
+            # arrow decodes and validates utf-8 without creating python objects
+            arrow = pa.array(values, type=pa.binary() if kind == 'S' else pa.string(), mask=mask if masked else None)
+            columns[name] = pd.array(arrow.cast(pa.string()), dtype=string_dtype)
+        elif kind in 'SU':
+            if kind == 'S':
+                try:
+                    values = values.astype('U') # fast for ascii
+                except UnicodeDecodeError:
+                    values = np.char.decode(values, 'utf-8')
+            values = values.astype(np.object_)
+            if masked:
+                values[mask] = np.nan
+            columns[name] = values
+        elif kind == 'O':
+            if any(isinstance(value, bytes) for value in values):
+                values = np.array([value.decode('utf-8') if isinstance(value, bytes) else value for value in values], dtype=np.object_)
+            elif masked:
+                values = values.copy()
+            if masked:
+                values[mask] = np.nan
+            columns[name] = values
+        elif name in ['time_min', 'time_max'] and kind == 'f':
+            columns[name] = julian_to_datetime64(values, mask | np.isnan(values))
+        elif kind in 'fc' and masked:
+            columns[name] = np.where(mask, np.nan, values)
+        elif kind in 'iu' and masked:
+            columns[name] = pd.arrays.IntegerArray(values, mask)
+        elif kind == 'b' and masked:
+            columns[name] = pd.arrays.BooleanArray(values, mask)
+        else:
+            columns[name] = values
 
-        if 'time_min' in data.columns:
-            data['time_min'] = pd.to_datetime(data['time_min'], origin='julian', unit='D') 
+    return pd.DataFrame(columns)
 
-        if 'time_max' in data.columns:
-            data['time_max'] = pd.to_datetime(data['time_max'], origin='julian', unit='D') 
 
-        if dropna:
-            data.dropna(inplace=True, axis=1, how='all')
+def julian_to_datetime64(jd, mask=None):
+    """Converts an array of julian days to datetime64[ns], with NaT where
+    mask is True. Whole days and the day fraction are converted separately
+    to preserve precision (results agree with pd.to_datetime(jd, unit='D',
+    origin='julian') to within a few ns, but run much faster)"""
 
-        if len(data) == 2000:
-            log.warn('results incomplete due to synchronous query limit - repeat with sync=false')
+    # masked entries (which may be NaN) are zeroed first, so that they can be cast
+    days = jd - julian_epoch if mask is None else np.where(mask, 0., jd - julian_epoch)
+    whole = np.trunc(days)
+    ns = whole.astype(np.int64) * ns_per_day + np.round((days - whole) * ns_per_day).astype(np.int64)
+    if mask is not None:
+        ns[mask] = np.datetime64('NaT').astype(np.int64)
 
-        return data# .squeeze()
+    return ns.view('datetime64[ns]')
+
+
+def normalise_adql(q):
+    """Normalises an ADQL query for use as a cache key by collapsing runs of
+    whitespace (outside quoted literals) and removing any trailing semicolon"""
+
+    # split into alternating unquoted and quoted ('...') parts
+    parts = re.split(r"('(?:[^']|'')*')", q.strip().rstrip(';').strip())
+    parts = [part if idx % 2 else re.sub(r'\s+', ' ', part) for idx, part in enumerate(parts)]
+
+    return ''.join(parts)
 
 
 def product_id_from_granule_uid(granule_uid):
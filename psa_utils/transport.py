@@ -0,0 +1,175 @@
+#!/usr/bin/python
+"""transport.py
+
+Mark S. Bentley (mark@lunartech.org), 2021
+
+A shared HTTP session layer used by the tap, pdap and download modules
+"""
+
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+
+import logging
+log = logging.getLogger(__name__)
+
+pool_size = 10 # connections kept alive per host
+timeout = (30, 600) # connect and read timeouts (seconds)
+retries = 3 # retries on connection errors and retry_status responses
+backoff_factor = 0.5 # seconds, doubled for each retry
+retry_status = [429, 500, 502, 503, 504]
+
+# one session per proxy setting, shared across the package
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class Session(requests.Session):
+    """A requests Session with keep-alive connection pooling, a default
+    timeout, retries with backoff on connection errors and 5xx/429 responses
+    (honouring Retry-After) and per-host request statistics. Only GET and
+    HEAD requests are retried once sent, since a POST may create a UWS job
+    (or other state) on the server"""
+
+    def __init__(self, pool_size=None, timeout=None, retries=None, backoff_factor=None, proxy=None):
+        """Accepts the following (None uses the module setting of the same name):
+
+        pool_size - number of connections kept alive for each host
+        timeout - default (connect, read) timeout in seconds, used when a
+            request does not give its own
+        retries - number of retries on connection errors or retry_status responses
+        backoff_factor - delay before the first retry, doubled for each retry
+        proxy - host:port of a SOCKS5 proxy, or None for a direct connection
+        """
+
+        super().__init__()
+
+        pool_size = globals()['pool_size'] if pool_size is None else pool_size
+        retries = globals()['retries'] if retries is None else retries
+        backoff_factor = globals()['backoff_factor'] if backoff_factor is None else backoff_factor
+        self.timeout = globals()['timeout'] if timeout is None else timeout
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=retry_status,
+            allowed_methods=['HEAD', 'GET'], # a retried POST could submit an asynchronous job twice
+            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        if proxy is not None:
+            self.proxies.update(proxy_dict(proxy))
+
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+
+    def request(self, method, url, **kwargs):
+        """Makes the request, applying the default timeout and recording the
+        latency (the time until the response headers are received)"""
+
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self._record(url, time.perf_counter() - start, error=True)
+            raise
+        self._record(url, time.perf_counter() - start, error=response.status_code >= 400)
+
+        return response
+
+
+    def _record(self, url, latency, error=False):
+
+        host = urlparse(url).netloc
+        with self._stats_lock:
+            entry = self._stats.setdefault(host, {
+                'requests': 0, 'errors': 0, 'total_time': 0., 'min_latency': None, 'max_latency': 0.})
+            entry['requests'] += 1
+            entry['errors'] += int(error)
+            entry['total_time'] += latency
+            entry['min_latency'] = latency if entry['min_latency'] is None else min(entry['min_latency'], latency)
+            entry['max_latency'] = max(entry['max_latency'], latency)
+
+
+    def stats(self):
+        """Returns a dictionary, keyed by host, of the number of requests and
+        errors and the mean, minimum and maximum latency in seconds"""
+
+        with self._stats_lock:
+            stats = {}
+            for host, entry in self._stats.items():
+                stats[host] = dict(entry, mean_latency=entry['total_time'] / entry['requests'])
+
+        return stats
+
+
+    def reset_stats(self):
+        """Clears the request statistics"""
+
+        with self._stats_lock:
+            self._stats = {}
+
+
+def proxy_dict(proxy):
+    """Returns the requests proxies dictionary for a SOCKS5 proxy given as host:port"""
+
+    return dict(http='socks5h://{:s}'.format(proxy), https='socks5h://{:s}'.format(proxy))
+
+
+def get_session(proxy=None):
+    """Returns the Session shared by the package for the given proxy (None
+    for direct connections), creating it with the module settings on first use"""
+
+    with _sessions_lock:
+        if proxy not in _sessions:
+            _sessions[proxy] = Session(proxy=proxy)
+
+    return _sessions[proxy]
+
+
+def configure(pool_size=None, timeout=None, retries=None, backoff_factor=None):
+    """Changes the module settings used for new sessions (None leaves a
+    setting unchanged). Any existing shared sessions are closed, and are
+    re-created with the new settings on next use. Objects already holding
+    a session keep using it."""
+
+    global _sessions
+
+    settings = {'pool_size': pool_size, 'timeout': timeout, 'retries': retries, 'backoff_factor': backoff_factor}
+    with _sessions_lock:
+        globals().update({key: value for key, value in settings.items() if value is not None})
+        for session in _sessions.values():
+            session.close()
+        _sessions = {}
+
+    return
+
+
+def stats():
+    """Returns the request statistics of all shared sessions, keyed by host"""
+
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+
+    totals = {}
+    for session in sessions:
+        for host, entry in session.stats().items():
+            if host not in totals:
+                totals[host] = dict(entry)
+                continue
+            total = totals[host]
+            total['requests'] += entry['requests']
+            total['errors'] += entry['errors']
+            total['total_time'] += entry['total_time']
+            total['min_latency'] = min(total['min_latency'], entry['min_latency'])
+            total['max_latency'] = max(total['max_latency'], entry['max_latency'])
+            total['mean_latency'] = total['total_time'] / total['requests']
+
+    return totals